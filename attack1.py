@@ -1,7 +1,6 @@
 # Approximation Attack 1 : Average Rank Thresholding
 
 import os
-import pickle
 
 import numpy as np
 import matplotlib.pyplot as plt
@@ -11,24 +10,22 @@ from sklearn import svm
 from sklearn.metrics import accuracy_score, roc_curve, roc_auc_score
 
 from models import UNITS, Decoder, Encoder
+from records import load_records
 from train import Translate
+from vocab import Vocab
 
 BATCH_SIZE = 64
 ###################################
 
-with open('data/satedrecord/inp_lang.pickle', 'rb') as handle, open('data/satedrecord/targ_lang.pickle', 'rb') as handle2:
-    inp_lang = pickle.load(handle)
-    targ_lang = pickle.load(handle2)
+inp_lang = Vocab.load('data/satedrecord/inp_lang.vocab')
+targ_lang = Vocab.load('data/satedrecord/targ_lang.vocab')
 
 
-in_train, in_train_label = np.load(
-    'data/satedrecord/in_train.npy'), np.load('data/satedrecord/in_train_label.npy')
-out_train, out_train_label = np.load(
-    'data/satedrecord/out_train.npy'), np.load('data/satedrecord/out_train_label.npy')
-in_test, in_test_label = np.load(
-    'data/satedrecord/in_test.npy'), np.load('data/satedrecord/in_test_label.npy')
-out_test, out_test_label = np.load(
-    'data/satedrecord/out_test.npy'), np.load('data/satedrecord/out_test_label.npy')
+records, records_meta = load_records('data/satedrecord/records.bundle')
+in_train, in_train_label = records['in_train']
+out_train, out_train_label = records['out_train']
+in_test, in_test_label = records['in_test']
+out_test, out_test_label = records['out_test']
 
 vocab_inp_size = len(inp_lang.word_index)+1
 vocab_tar_size = len(targ_lang.word_index)+1
@@ -36,7 +33,7 @@ vocab_tar_size = len(targ_lang.word_index)+1
 encoder = Encoder(vocab_inp_size, BATCH_SIZE)
 decoder = Decoder(vocab_tar_size, BATCH_SIZE)
 spa_eng_max_length_targ, spa_eng_max_length_inp = 11, 16
-max_length_targ, max_length_inp = 65, 67
+max_length_targ, max_length_inp = records_meta['max_length_targ'], records_meta['max_length_inp']
 optimizer = tf.keras.optimizers.Adam()
 
 checkpoint_dir = './checkpoints/satedrecord/training_checkpoints'
@@ -50,21 +47,17 @@ minimum = min(len(in_train), len(out_train))
 
 
 def translate_and_get_indices(tr, tar, pred_probs):
-    res = ''
-    for word in tar:
-        if word != 0:
-            res += targ_lang.index_word[word] + ' '
-    res = res.split(' ', 1)[1]
+    # reference ids after <start>; same ids the old id -> word -> id round trip produced
+    res = tar[tar != 0][1:]
 
-    ### score = sentence_bleu([tr.split()], res.split())
+    ### score = sentence_bleu([tr.split()], targ_lang.decode(res).split())
 
     indices = []
 
-    for word, prob in zip(res.split(), pred_probs):
+    for ind, prob in zip(res, pred_probs):
         temp = (-prob).argsort()[:len(prob)]
         ranks = np.empty_like(temp)
         ranks[temp] = np.arange(len(prob))
-        ind = targ_lang.word_index[word]
         indices.append(ranks[ind])
 
     return indices
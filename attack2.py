@@ -1,7 +1,5 @@
 # Approximation Attack 2 : Shadow Models on Rank
 
-import os
-import pickle
 import time
 
 import numpy as np
@@ -11,41 +9,39 @@ from nltk.translate.bleu_score import sentence_bleu
 from sklearn import svm
 from sklearn.metrics import accuracy_score, roc_auc_score, roc_curve
 
+from records import load_records
 from shadow_model import SHADOW_UNITS, ShadowDecoder, ShadowEncoder
-from train import Train, Translate
+from train import StackedTrain, Train, Translate, restore_checkpoint
+from vocab import Vocab
 
 NUM_SHADOW_MODELS = 4
 BATCH_SIZE = 128
 EPOCHS = 15
+TRAIN_GROUPED = True
 shadow_checkpoint_dir = './checkpoints/satedrecord/shadow_checkpoints'
 
-with open('data/satedrecord/inp_lang.pickle', 'rb') as handle, open('data/satedrecord/targ_lang.pickle', 'rb') as handle2:
-    inp_lang = pickle.load(handle)
-    targ_lang = pickle.load(handle2)
+inp_lang = Vocab.load('data/satedrecord/inp_lang.vocab')
+targ_lang = Vocab.load('data/satedrecord/targ_lang.vocab')
 
 
-in_train, in_train_label = np.load(
-    'data/satedrecord/in_train.npy'), np.load('data/satedrecord/in_train_label.npy')
-out_train, out_train_label = np.load(
-    'data/satedrecord/out_train.npy'), np.load('data/satedrecord/out_train_label.npy')
-in_test, in_test_label = np.load(
-    'data/satedrecord/in_test.npy'), np.load('data/satedrecord/in_test_label.npy')
-out_test, out_test_label = np.load(
-    'data/satedrecord/out_test.npy'), np.load('data/satedrecord/out_test_label.npy')
+records, records_meta = load_records('data/satedrecord/records.bundle')
+in_train, in_train_label = records['in_train']
+out_train, out_train_label = records['out_train']
+in_test, in_test_label = records['in_test']
+out_test, out_test_label = records['out_test']
 
-print(in_train.shape, in_train_label.shape,
-      out_train.shape, out_train_label.shape)
-
-BUFFER_SIZE = len(in_train)
+print(len(in_train), len(in_train_label),
+      len(out_train), len(out_train_label))
 
 vocab_inp_size = len(inp_lang.word_index)+1
 vocab_tar_size = len(targ_lang.word_index)+1
-max_length_targ, max_length_inp = 65, 67
+max_length_targ, max_length_inp = records_meta['max_length_targ'], records_meta['max_length_inp']
 
 minimum = min(len(in_train), len(out_train))
 
 
 ds_size = minimum // NUM_SHADOW_MODELS
+BUFFER_SIZE = ds_size
 
 loss_object = tf.keras.losses.SparseCategoricalCrossentropy(
     from_logits=True, reduction='none')
@@ -62,21 +58,17 @@ def loss_function(real, pred):
 
 
 def translate_and_get_indices(tr, tar, pred_probs):
-    res = ''
-    for word in tar:
-        if word != 0:
-            res += targ_lang.index_word[word] + ' '
-    res = res.split(' ', 1)[1]
+    # reference ids after <start>; same ids the old id -> word -> id round trip produced
+    res = tar[tar != 0][1:]
 
-    ### score = sentence_bleu([tr.split()], res.split())
+    ### score = sentence_bleu([tr.split()], targ_lang.decode(res).split())
 
     indices = []
 
-    for word, prob in zip(res.split(), pred_probs):
+    for ind, prob in zip(res, pred_probs):
         temp = (-prob).argsort()[:len(prob)]
         ranks = np.empty_like(temp)
         ranks[temp] = np.arange(len(prob))
-        ind = targ_lang.word_index[word]
         indices.append(ranks[ind])
 
     return indices
@@ -85,68 +77,110 @@ def translate_and_get_indices(tr, tar, pred_probs):
 train_indices = []
 test_indices = []
 
+shadows = []
 for m in range(NUM_SHADOW_MODELS):
     # TODO : Change inp_size
-    print('Training shadow model', m)
     input_tensor_train_slice = in_train[m * ds_size: (m+1) * ds_size]
     target_tensor_train_slice = in_train_label[m *
                                                ds_size: (m+1) * ds_size]
 
-    input_tensor_val_slice = out_train[m * ds_size: (m+1) * ds_size]
-    target_tensor_val_slice = out_train_label[m * ds_size: (m+1) * ds_size]
-
     shadow_encoder = ShadowEncoder(vocab_inp_size, BATCH_SIZE)
     shadow_decoder = ShadowDecoder(vocab_tar_size, BATCH_SIZE)
 
     shadow_optimizer = tf.keras.optimizers.Adam()
 
-    shadow_checkpoint_prefix = os.path.join(
-        shadow_checkpoint_dir + str(m), "ckptshadow"+str(m))
-
     shadow_checkpoint = tf.train.Checkpoint(optimizer=shadow_optimizer,
                                             encoder=shadow_encoder,
-                                            decoder=shadow_decoder)
+                                            decoder=shadow_decoder,
+                                            epoch=tf.Variable(0, dtype=tf.int64))
+    shadow_checkpoint_manager = tf.train.CheckpointManager(shadow_checkpoint, shadow_checkpoint_dir + str(m),
+                                                           max_to_keep=None, checkpoint_name="ckptshadow"+str(m))
+    # models whose checkpoint is already at EPOCHS are not trained again
+    start_epoch = restore_checkpoint(shadow_checkpoint, shadow_checkpoint_manager)
 
     dataset = tf.data.Dataset.from_tensor_slices(
-        (in_train, in_train_label)).shuffle(BUFFER_SIZE)
+        (input_tensor_train_slice.to_padded(max_length_inp),
+         target_tensor_train_slice.to_padded(max_length_targ))).shuffle(BUFFER_SIZE)
     dataset = dataset.batch(BATCH_SIZE, drop_remainder=True)
 
     train = Train(shadow_encoder, shadow_decoder, shadow_optimizer,
                   loss_function, BATCH_SIZE, targ_lang)
-    steps_per_epoch = len(in_train)//BATCH_SIZE
 
-    translator = Translate(shadow_encoder, shadow_decoder, SHADOW_UNITS,
-                                inp_lang, targ_lang, max_length_targ, max_length_inp)
+    shadows.append((shadow_encoder, shadow_decoder, shadow_checkpoint, shadow_checkpoint_manager, start_epoch,
+                    dataset, train))
+
+steps_per_epoch = ds_size//BATCH_SIZE
+
 
-    for epoch in range(EPOCHS):
+def save_shadow_checkpoint(checkpoint, manager, epoch):
+    checkpoint.epoch.assign(epoch + 1)
+    if (epoch + 1) % 2 == 0 or epoch + 1 == EPOCHS:
+        manager.save()
+
+
+if TRAIN_GROUPED:
+    # the shadow models train as one stacked model, each on its own slice with its own Adam state;
+    # models restored at a later epoch join once the others catch up
+    members, stacked_train = (), None
+    for epoch in range(min(shadow[4] for shadow in shadows), EPOCHS):
         start = time.time()
 
-        enc_hidden = shadow_encoder.initialize_hidden_state()
+        if len(members) < sum(shadow[4] <= epoch for shadow in shadows):
+            members = tuple(m for m, shadow in enumerate(shadows) if shadow[4] <= epoch)
+            stacked_train = StackedTrain([shadows[m][6] for m in members])
+        print('Training shadow models', *members)
+
         total_loss = 0
-        for (batch, (inp, targ)) in enumerate(dataset.take(steps_per_epoch)):
-            batch_loss = train.train_step(inp, targ, enc_hidden)
+        datasets = [shadows[m][5].take(steps_per_epoch) for m in members]
+        for (batch, batches) in enumerate(zip(*datasets)):
+            batch_loss = stacked_train.train_step(tf.stack([inp for inp, _ in batches]),
+                                                  tf.stack([targ for _, targ in batches]))
             total_loss += batch_loss
 
             if batch % 100 == 0:
-                print('Epoch {} Batch {} Loss {:.4f}'.format(epoch + 1,
-                                                             batch,
-                                                             batch_loss.numpy()))
+                print('Epoch {} Batch {} Loss {}'.format(epoch + 1, batch,
+                                                         ' '.join('{:.4f}'.format(l) for l in batch_loss.numpy())))
 
-        if (epoch + 1) % 2 == 0:
-            shadow_checkpoint.save(file_prefix=shadow_checkpoint_prefix)
+        stacked_train.save()
+        for m in members:
+            save_shadow_checkpoint(shadows[m][2], shadows[m][3], epoch)
 
-        print('Epoch {} Loss {:.4f}'.format(epoch + 1,
-                                            total_loss / steps_per_epoch))
+        print('Epoch {} Loss {}'.format(epoch + 1, ' '.join('{:.4f}'.format(l)
+                                                            for l in (total_loss / steps_per_epoch).numpy())))
         print('Time taken for 1 epoch {} sec\n'.format(time.time() - start))
 
+for m, (shadow_encoder, shadow_decoder, shadow_checkpoint, shadow_checkpoint_manager, start_epoch, dataset, train) \
+        in enumerate(shadows):
+    if not TRAIN_GROUPED:
+        print('Training shadow model', m)
+        for epoch in range(start_epoch, EPOCHS):
+            start = time.time()
+
+            enc_hidden = shadow_encoder.initialize_hidden_state()
+            total_loss = 0
+            for (batch, (inp, targ)) in enumerate(dataset.take(steps_per_epoch)):
+                batch_loss = train.train_step(inp, targ, enc_hidden)
+                total_loss += batch_loss
+
+                if batch % 100 == 0:
+                    print('Epoch {} Batch {} Loss {:.4f}'.format(epoch + 1,
+                                                                 batch,
+                                                                 batch_loss.numpy()))
+
+            save_shadow_checkpoint(shadow_checkpoint, shadow_checkpoint_manager, epoch)
+
+            print('Epoch {} Loss {:.4f}'.format(epoch + 1,
+                                                total_loss / steps_per_epoch))
+            print('Time taken for 1 epoch {} sec\n'.format(time.time() - start))
+
+    translator = Translate(shadow_encoder, shadow_decoder, SHADOW_UNITS,
+                                inp_lang, targ_lang, max_length_targ, max_length_inp)
+
+    # members are the m-th slice the model was trained on, non-members the m-th slice of out_train
     in_train_indices = []
     pred_probs_in_train = []
 
-    i = 0
-    for ten, tar in zip(in_train, in_train_label):
-        i += 1
-        if i > ds_size:
-            break
+    for ten, tar in zip(in_train[m * ds_size: (m+1) * ds_size], in_train_label[m * ds_size: (m+1) * ds_size]):
         tr, pred_probs = translator.translate(ten, True)
         pred_probs_in_train.append(pred_probs)
         indices = translate_and_get_indices(tr, tar, pred_probs)
@@ -154,11 +188,7 @@ for m in range(NUM_SHADOW_MODELS):
 
     out_train_indices = []
     pred_probs_out_train = []
-    i = 0
-    for ten, tar in zip(out_train, out_train_label):
-        i += 1
-        if i > ds_size:
-            break
+    for ten, tar in zip(out_train[m * ds_size: (m+1) * ds_size], out_train_label[m * ds_size: (m+1) * ds_size]):
         tr, pred_probs = translator.translate(ten, True)
         pred_probs_out_train.append(pred_probs)
         indices = translate_and_get_indices(tr, tar, pred_probs)
@@ -0,0 +1,71 @@
+import json
+import os
+
+import numpy as np
+
+BUNDLE_MAGIC = b'NPBUNDLE'
+BUNDLE_ALIGN = 64
+
+
+def _align(n):
+    return (n + BUNDLE_ALIGN - 1) // BUNDLE_ALIGN * BUNDLE_ALIGN
+
+
+def save_bundle(path, arrays, meta=None):
+    # Layout: magic, header length, json header, then every array at a 64-byte aligned offset so that
+    # load_bundle can hand out np.memmap views without copying.
+    arrays = {name: np.ascontiguousarray(a) for name, a in arrays.items()}
+    entries = {}
+    offset = 0
+    for name, a in arrays.items():
+        if a.dtype.hasobject:
+            raise ValueError('Cannot bundle object array {}'.format(name))
+        entries[name] = {'dtype': a.dtype.str, 'shape': list(a.shape), 'offset': offset}
+        offset = _align(offset + a.nbytes)
+
+    header = json.dumps({'arrays': entries, 'meta': meta or {}}).encode('UTF-8')
+    data_start = _align(len(BUNDLE_MAGIC) + 8 + len(header))
+
+    # write to a temporary file first so concurrent readers never see a partial bundle
+    tmp_path = '{}.tmp{}'.format(path, os.getpid())
+    with open(tmp_path, 'wb') as f:
+        f.write(BUNDLE_MAGIC)
+        f.write(np.uint64(len(header)).tobytes())
+        f.write(header)
+        for name, a in arrays.items():
+            f.seek(data_start + entries[name]['offset'])
+            a.tofile(f)
+    os.replace(tmp_path, path)
+
+
+def load_bundle(path):
+    with open(path, 'rb') as f:
+        if f.read(len(BUNDLE_MAGIC)) != BUNDLE_MAGIC:
+            raise ValueError('{} is not an array bundle'.format(path))
+        header_len = int(np.frombuffer(f.read(8), dtype=np.uint64)[0])
+        header = json.loads(f.read(header_len).decode('UTF-8'))
+
+    data_start = _align(len(BUNDLE_MAGIC) + 8 + header_len)
+    arrays = {}
+    for name, entry in header['arrays'].items():
+        dtype = np.dtype(entry['dtype'])
+        shape = tuple(entry['shape'])
+        if int(np.prod(shape)) == 0:
+            # np.memmap refuses zero-length regions
+            arrays[name] = np.empty(shape, dtype=dtype)
+        else:
+            arrays[name] = np.memmap(path, dtype=dtype, mode='r', offset=data_start + entry['offset'], shape=shape)
+    return arrays, header['meta']
+
+
+def encode_strings(strings):
+    data = [s.encode('UTF-8') for s in strings]
+    offsets = np.zeros(len(data) + 1, dtype=np.int64)
+    np.cumsum(np.fromiter((len(b) for b in data), dtype=np.int64, count=len(data)), out=offsets[1:])
+    return np.frombuffer(b''.join(data), dtype=np.uint8), offsets
+
+
+def decode_strings(blob, offsets):
+    data = np.asarray(blob).tobytes()
+    offsets = np.asarray(offsets).tolist()
+    return [data[start:end].decode('UTF-8') for start, end in zip(offsets[:-1], offsets[1:])]
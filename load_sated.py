@@ -1,9 +1,21 @@
+import hashlib
+import io
+import json
+import os
+import sys
+from array import array
+from multiprocessing import Pool
+
 import numpy as np
-from collections import Counter, defaultdict
-from itertools import chain
+from collections import Counter
+
+from bundle import save_bundle, load_bundle, encode_strings, decode_strings
+from ragged import RaggedArray
 
 
-SATED_PATH = 'sated-release-0.9.0/en-fr/'
+SATED_RELEASE = 'sated-release-0.9.0/'
+SATED_PAIRS = ('en-de', 'en-es', 'en-fr')
+SATED_PATH = SATED_RELEASE + 'en-fr/'
 SATED_TRAIN_ENG = SATED_PATH + 'train.en'
 SATED_TRAIN_FR = SATED_PATH + 'train.fr'
 SATED_TRAIN_USER = SATED_PATH + 'train.usr'
@@ -13,6 +25,15 @@ SATED_DEV_USER = SATED_PATH + 'dev.usr'
 SATED_TEST_ENG = SATED_PATH + 'test.en'
 SATED_TEST_FR = SATED_PATH + 'test.fr'
 SATED_TEST_USER = SATED_PATH + 'test.usr'
+SATED_SPLITS = ('train', 'dev', 'test')
+SATED_CORPUS_VERSION = 1
+SATED_CORPUS = 'compiled/corpus.bundle'
+SATED_USER_INDEX = 'compiled/users_seed{}.bundle'
+SATED_SPLIT_VERSION = 1
+SATED_SPLIT = 'compiled/split_{}.bundle'
+# compiled splits kept per language pair; the least recently used ones are evicted past this size
+SATED_SPLIT_CACHE_BYTES = 2 * 1024 ** 3
+VOCAB_CHUNK_SIZE = 64 * 1024 * 1024
 # EUROPARL_PATH = '/hdd/song/nlp/europarl/'
 # EUROPARL_DEEN_DE = EUROPARL_PATH + 'europarl.de-en.de.aligned.tok'
 # EUROPARL_DEEN_EN = EUROPARL_PATH + 'europarl.de-en.en.aligned.tok'
@@ -20,7 +41,113 @@ SATED_TEST_USER = SATED_PATH + 'test.usr'
 # EUROPARL_FREN_EN = EUROPARL_PATH + 'europarl.fr-en.en.aligned.tok'
 
 
+def split_line(line):
+    return ['<sos>'] + line.replace('\n', '').split(' ') + ['<eos>']
+
+
+def encode_file(p, word_ids, tokenize=True):
+    # token ids share one id space per language across train/dev/test
+    ids = array('i')
+    offsets = array('q', [0])
+    with open(p, 'r', encoding='UTF-8') as f:
+        for line in f:
+            words = split_line(line) if tokenize else [line.replace('\n', '')]
+            ids.extend(word_ids.setdefault(w, len(word_ids)) for w in words)
+            offsets.append(len(ids))
+    return np.frombuffer(ids, dtype=np.int32), np.frombuffer(offsets, dtype=np.int64)
+
+
+def sated_path(pair='en-fr'):
+    return SATED_RELEASE + pair + '/'
+
+
+def sated_langs(path=SATED_PATH):
+    # (source, target) language of a pair directory, e.g. ('en', 'fr') for .../en-fr/
+    return tuple(os.path.basename(os.path.normpath(path)).split('-'))
+
+
+def sated_sources(path=SATED_PATH):
+    return [path + '{}.{}'.format(split, ext) for split in SATED_SPLITS for ext in sated_langs(path) + ('usr',)]
+
+
+def source_stamps(path=SATED_PATH):
+    stamps = {}
+    for p in sated_sources(path):
+        st = os.stat(p)
+        stamps[os.path.basename(p)] = [st.st_size, st.st_mtime]
+    return stamps
+
+
+def compile_sated_corpus(path=SATED_PATH):
+    # One-time pass over the raw text: every file becomes int32 token ids plus int64 sentence offsets,
+    # and all of it goes into a single bundle that later loads are served from via mmap.
+    arrays = {}
+    tables = {}
+    for split in SATED_SPLITS:
+        for ext in sated_langs(path) + ('usr',):
+            table = tables.setdefault(ext, {})
+            ids, offsets = encode_file(path + '{}.{}'.format(split, ext), table, tokenize=ext != 'usr')
+            arrays['{}.{}.ids'.format(split, ext)] = ids
+            if ext != 'usr':
+                arrays['{}.{}.offsets'.format(split, ext)] = offsets
+
+    for ext, table in tables.items():
+        arrays[ext + '.words'], arrays[ext + '.words_offsets'] = encode_strings(table)
+
+    corpus_path = path + SATED_CORPUS
+    os.makedirs(os.path.dirname(corpus_path), exist_ok=True)
+    save_bundle(corpus_path, arrays, meta={'version': SATED_CORPUS_VERSION, 'sources': source_stamps(path)})
+    print('Compiled SATED corpus to {}'.format(corpus_path))
+
+
+_corpora = {}
+
+
+def load_sated_corpus(path=SATED_PATH):
+    if path in _corpora:
+        return _corpora[path]
+
+    if not all(os.path.exists(p) for p in sated_sources(path)):
+        return None
+
+    corpus_path = path + SATED_CORPUS
+    meta = load_bundle(corpus_path)[1] if os.path.exists(corpus_path) else None
+    if meta is None or meta.get('version') != SATED_CORPUS_VERSION or meta.get('sources') != source_stamps(path):
+        compile_sated_corpus(path)
+
+    arrays, _ = load_bundle(corpus_path)
+    tables = {}
+    for ext in sated_langs(path) + ('usr',):
+        tables[ext] = decode_strings(arrays.pop(ext + '.words'), arrays.pop(ext + '.words_offsets'))
+        if ext != 'usr' and '<unk>' not in tables[ext]:
+            # give out-of-vocabulary remapping an id to point at
+            tables[ext].append('<unk>')
+    _corpora[path] = arrays, tables
+    return _corpora[path]
+
+
+def load_compiled(p):
+    # returns (ids, offsets, words) for a SATED file, or None when it is not part of a compiled corpus
+    path = os.path.dirname(p) + '/'
+    name = os.path.basename(p).split('.')
+    if len(name) != 2 or name[0] not in SATED_SPLITS or name[1] not in sated_langs(path) + ('usr',):
+        return None
+    corpus = load_sated_corpus(path)
+    if corpus is None:
+        return None
+
+    arrays, tables = corpus
+    split, ext = name
+    offsets = arrays.get('{}.{}.offsets'.format(split, ext))
+    return arrays['{}.{}.ids'.format(split, ext)], offsets, tables[ext]
+
+
 def load_users(p=SATED_TRAIN_USER):
+    compiled = load_compiled(p)
+    if compiled is not None:
+        ids, _, words = compiled
+        return np.asarray(words, dtype=object)[ids].tolist()
+
     users = []
     with open(p, 'r', encoding='UTF-8') as f:
         for line in f:
@@ -29,18 +156,222 @@ def load_users(p=SATED_TRAIN_USER):
 
 
 def load_texts(p=SATED_TRAIN_ENG):
+    compiled = load_compiled(p)
+    if compiled is not None:
+        ids, offsets, words = compiled
+        return RaggedArray(np.asarray(words, dtype=object)[ids], offsets).tolist()
+
     texts = []
     with open(p, 'r', encoding='UTF-8') as f:
         for line in f:
-            arr = ['<sos>'] + line.replace('\n', '').split(' ') + ['<eos>']
-            words = []
-            for w in arr:
-                words.append(w)
-            texts.append(words)
+            texts.append(split_line(line))
+
+    return texts
+
+
+def load_ragged(p):
+    # (RaggedArray of corpus token ids, id -> word table) for a SATED text file
+    compiled = load_compiled(p)
+    if compiled is None:
+        raise FileNotFoundError(p)
+    ids, offsets, words = compiled
+    return RaggedArray(ids, offsets), words
+
+
+def build_user_index(path=SATED_PATH, seed=12345):
+    corpus = load_sated_corpus(path)
+    if corpus is None:
+        raise FileNotFoundError('SATED sources missing under {}'.format(path))
+    arrays, tables = corpus
+    user_ids = np.asarray(arrays['train.usr.ids'])
+    counts = np.bincount(user_ids, minlength=len(tables['usr']))
+
+    # Same order as Counter.most_common() over the train users: count descending, ties in first-appearance
+    # order, which is the order compile_sated_corpus assigned user ids in. Then the usual seeded shuffle.
+    all_users = [u for u in np.argsort(-counts, kind='stable').tolist() if counts[u] > 0]
+    np.random.seed(seed)
+    np.random.shuffle(all_users)
+    np.random.seed(None)
+
+    users = np.asarray(all_users, dtype=np.int32)
+    rank = np.full(len(counts), -1, dtype=np.int64)
+    rank[users] = np.arange(len(users))
+    # stable sort keeps each user's sentences in corpus order, the held-out split depends on it
+    sentences = np.argsort(rank[user_ids], kind='stable')
+    offsets = np.zeros(len(users) + 1, dtype=np.int64)
+    np.cumsum(counts[users], out=offsets[1:])
+
+    save_bundle(path + SATED_USER_INDEX.format(seed), {'users': users, 'offsets': offsets, 'sentences': sentences},
+                meta={'version': SATED_CORPUS_VERSION, 'seed': seed, 'sources': source_stamps(path)})
+
+
+_user_indexes = {}
+
+
+def load_user_index(path=SATED_PATH, seed=12345):
+    # users in the seeded shuffle order, each mapped to a contiguous run of `sentences` (train sentence ids)
+    if (path, seed) in _user_indexes:
+        return _user_indexes[(path, seed)]
+
+    index_path = path + SATED_USER_INDEX.format(seed)
+    if load_sated_corpus(path) is None:
+        raise FileNotFoundError('SATED sources missing under {}'.format(path))
+    meta = load_bundle(index_path)[1] if os.path.exists(index_path) else None
+    if meta is None or meta.get('version') != SATED_CORPUS_VERSION or meta.get('sources') != source_stamps(path):
+        build_user_index(path, seed)
+
+    arrays, _ = load_bundle(index_path)
+    user_names = load_sated_corpus(path)[1]['usr']
+    users = [user_names[u] for u in arrays['users'].tolist()]
+    index = {'users': users, 'positions': {u: i for i, u in enumerate(users)},
+             'offsets': np.asarray(arrays['offsets']), 'sentences': arrays['sentences']}
+    _user_indexes[(path, seed)] = index
+    return index
+
 
+def user_rows(index, u):
+    pos = index['positions'][u]
+    return index['sentences'][index['offsets'][pos]:index['offsets'][pos + 1]]
+
+
+def load_user_texts(users, p, index):
+    # reads only the rows of `users` (corpus order per user) with one gather; each user gets a view of it
+    texts, _ = load_ragged(p)
+    users = [u for u in users if u in index['positions']]
+    rows = [user_rows(index, u) for u in users]
+    gathered = texts[np.concatenate(rows) if rows else []]
+
+    user_texts = {}
+    start = 0
+    for u, r in zip(users, rows):
+        user_texts[u] = gathered[start:start + len(r)]
+        start += len(r)
+    return user_texts
+
+
+def vocab_lut(words, vocabs):
+    # corpus id -> vocabulary id, out-of-vocabulary words go to <unk> like process_texts does
+    lut = np.array([vocabs.get(w, -1) for w in words], dtype=np.int32)
+    if '<unk>' in vocabs:
+        lut[lut < 0] = vocabs['<unk>']
+    return lut
+
+
+def encode_texts(texts, lut):
+    texts = texts.map(lut)
+    if len(texts.values) and texts.values.min() < 0:
+        # the old string pipeline failed the same way, just later in words_to_indices
+        raise KeyError('<unk> is not in the vocabulary but the texts contain out-of-vocabulary words')
     return texts
 
 
+def encode_user_texts(user_texts, lut):
+    # one remap over all users' rows, handed back as per-user views
+    users = list(user_texts)
+    texts = encode_texts(RaggedArray.concatenate(user_texts[u] for u in users), lut)
+    encoded = {}
+    start = 0
+    for u in users:
+        encoded[u] = texts[start:start + len(user_texts[u])]
+        start += len(user_texts[u])
+    return encoded
+
+
+def rank_vocabs(words, counts, num_words=None):
+    # ids of the counted words in process_vocabs order: count descending, then lexicographic
+    lexical = np.empty(len(words), dtype=np.int64)
+    lexical[sorted(range(len(words)), key=words.__getitem__)] = np.arange(len(words))
+    ids = np.flatnonzero(counts)
+    ids = ids[np.lexsort((lexical[ids], -counts[ids]))]
+    print('Loaded {} vocabs'.format(len(ids)))
+
+    if num_words is not None:
+        ids = ids[:num_words - 1]
+
+    count_pairs = list(zip([words[i] for i in ids[:50].tolist()], counts[ids[:50]].tolist()))
+    print(f"Count pairs (first 50): {count_pairs}".encode('UTF-8'))
+    return ids
+
+
+def vocabs_from_counts(words, counts, num_words=10000):
+    # Equivalent of process_vocabs -> process_texts -> process_vocabs(None) given per-word counts.
+    # Returns word_to_id and a words -> word_to_id lookup table.
+    kept = rank_vocabs(words, counts, num_words)
+
+    # The <unk> substitution keeps the counts of the top words and moves everything else onto <unk>,
+    # so the second count follows from the first without another pass over the tokens.
+    unk = words.index('<unk>')
+    kept_counts = np.zeros_like(counts)
+    kept_counts[kept] = counts[kept]
+    kept_counts[unk] += counts.sum() - counts[kept].sum()
+    final = rank_vocabs(words, kept_counts, None)
+
+    vocabs = dict(zip([words[i] for i in final.tolist()], np.arange(len(final))))
+    lut = np.full(len(words), -1, dtype=np.int32)
+    lut[final] = np.arange(len(final))
+    if '<unk>' in vocabs:
+        lut[lut < 0] = vocabs['<unk>']
+    return vocabs, lut
+
+
+def build_vocabs(texts, words, num_words=10000):
+    # vocabulary of the training texts, a RaggedArray of corpus ids
+    return vocabs_from_counts(words, np.bincount(texts.values, minlength=len(words)), num_words)
+
+
+def file_chunks(p, chunk_size=VOCAB_CHUNK_SIZE):
+    # byte ranges of roughly chunk_size that start and end on line boundaries
+    size = os.path.getsize(p)
+    bounds = [0]
+    with open(p, 'rb') as f:
+        while bounds[-1] < size:
+            f.seek(min(bounds[-1] + chunk_size, size))
+            f.readline()
+            bounds.append(min(f.tell(), size))
+    return [(p, start, end) for start, end in zip(bounds[:-1], bounds[1:])]
+
+
+def count_chunk(chunk):
+    p, start, end = chunk
+    with open(p, 'rb') as f:
+        f.seek(start)
+        data = f.read(end - start)
+
+    counter = Counter()
+    # same newline handling and tokenization as load_texts
+    for line in io.TextIOWrapper(io.BytesIO(data), encoding='UTF-8'):
+        counter.update(split_line(line))
+    return counter
+
+
+def count_file_vocabs(p, chunk_size=VOCAB_CHUNK_SIZE, processes=None):
+    # Word counts of a text file without loading it: memory is one chunk per worker plus the partial
+    # Counters, which are merged as they come back.
+    chunks = file_chunks(p, chunk_size)
+    counter = Counter()
+    if processes == 1 or len(chunks) <= 1:
+        for chunk in chunks:
+            counter.update(count_chunk(chunk))
+    else:
+        with Pool(processes) as pool:
+            for partial in pool.imap_unordered(count_chunk, chunks):
+                counter.update(partial)
+    return counter
+
+
+def load_streaming_vocabs(src_path=SATED_TRAIN_ENG, trg_path=SATED_TRAIN_FR, num_words=10000,
+                          chunk_size=VOCAB_CHUNK_SIZE, processes=None):
+    # same src_vocabs/trg_vocabs as load_sated_data, for corpora that do not fit in memory
+    vocabs = []
+    for p in (src_path, trg_path):
+        counter = count_file_vocabs(p, chunk_size, processes)
+        counter['<unk>'] += 0
+        words = list(counter)
+        counts = np.fromiter(counter.values(), dtype=np.int64, count=len(words))
+        vocabs.append(vocabs_from_counts(words, counts, num_words)[0])
+    return vocabs[0], vocabs[1]
+
+
 def process_texts(texts, vocabs):
     for t in texts:
         for i, w in enumerate(t):
@@ -63,131 +394,233 @@ def process_vocabs(vocabs, num_words=10000):
     return word_to_id
 
 
-def load_sated_data(num_words=10000):
-    train_src_texts = load_texts(SATED_TRAIN_ENG)
-    train_trg_texts = load_texts(SATED_TRAIN_FR)
-
-    dev_src_texts = load_texts(SATED_DEV_ENG)
-    dev_trg_texts = load_texts(SATED_DEV_FR)
+def split_key(kind, params, users, path=SATED_PATH):
+    # hash of everything a user split depends on: parameters, the chosen users and the source files
+    key = {'version': SATED_SPLIT_VERSION, 'corpus_version': SATED_CORPUS_VERSION, 'kind': kind, 'params': params,
+           'users': sorted(str(u) for u in users), 'sources': source_stamps(path)}
+    return hashlib.sha1(json.dumps(key, sort_keys=True).encode('UTF-8')).hexdigest()
+
+
+def save_split(key, parts, vocabs, path=SATED_PATH):
+    # parts: name -> RaggedArray or {user: RaggedArray}, vocabs: name -> word_to_id
+    arrays = {}
+    for name, texts in parts.items():
+        if isinstance(texts, dict):
+            users = list(texts)
+            arrays[name + '.users'], arrays[name + '.users_offsets'] = encode_strings([str(u) for u in users])
+            rows = np.zeros(len(users) + 1, dtype=np.int64)
+            np.cumsum(np.fromiter((len(texts[u]) for u in users), dtype=np.int64, count=len(users)), out=rows[1:])
+            arrays[name + '.user_rows'] = rows
+            texts = RaggedArray.concatenate(texts[u] for u in users)
+        arrays[name + '.values'] = texts.values
+        arrays[name + '.offsets'] = texts.offsets
+
+    for name, word_to_id in vocabs.items():
+        words = sorted(word_to_id, key=word_to_id.get)
+        arrays[name + '.words'], arrays[name + '.words_offsets'] = encode_strings(words)
+
+    split_path = path + SATED_SPLIT.format(key)
+    save_bundle(split_path, arrays, meta={'parts': list(parts), 'vocabs': list(vocabs)})
+    prune_splits(path, keep=(split_path,))
+
+
+def split_bundles(path=SATED_PATH):
+    split_dir = os.path.dirname(path + SATED_SPLIT)
+    if not os.path.isdir(split_dir):
+        return []
+    prefix, suffix = os.path.basename(SATED_SPLIT).split('{}')
+    return [os.path.join(split_dir, name) for name in os.listdir(split_dir)
+            if name.startswith(prefix) and name.endswith(suffix)]
+
+
+def prune_splits(path=SATED_PATH, max_bytes=None, keep=()):
+    # evicts split bundles, least recently used first (load_split touches them), until the rest fit in
+    # max_bytes (SATED_SPLIT_CACHE_BYTES by default); a split still mapped by a running process stays
+    # readable until it is unmapped
+    if max_bytes is None:
+        max_bytes = SATED_SPLIT_CACHE_BYTES
+    splits = []
+    for p in split_bundles(path):
+        try:
+            st = os.stat(p)
+        except FileNotFoundError:
+            continue
+        splits.append((st.st_mtime, st.st_size, p))
+
+    total = sum(size for _, size, _ in splits)
+    removed = 0
+    for _, size, p in sorted(splits):
+        if total <= max_bytes:
+            break
+        if p in keep:
+            continue
+        try:
+            os.remove(p)
+        except FileNotFoundError:
+            pass
+        total -= size
+        removed += 1
+    return removed
+
+
+def load_split(key, path=SATED_PATH):
+    split_path = path + SATED_SPLIT.format(key)
+    if not os.path.exists(split_path):
+        return None
+    # mark as recently used for prune_splits
+    os.utime(split_path)
+
+    arrays, meta = load_bundle(split_path)
+    parts = {}
+    for name in meta['parts']:
+        texts = RaggedArray(arrays[name + '.values'], arrays[name + '.offsets'])
+        if name + '.users' in arrays:
+            users = decode_strings(arrays[name + '.users'], arrays[name + '.users_offsets'])
+            rows = arrays[name + '.user_rows'].tolist()
+            texts = {u: texts[start:end] for u, start, end in zip(users, rows[:-1], rows[1:])}
+        parts[name] = texts
+
+    vocabs = {}
+    for name in meta['vocabs']:
+        words = decode_strings(arrays[name + '.words'], arrays[name + '.words_offsets'])
+        vocabs[name] = dict(zip(words, np.arange(len(words))))
+    return parts, vocabs
+
+
+def build_full_split(num_words=10000, path=SATED_PATH):
+    src, trg = sated_langs(path)
+    train_src_texts, src_words = load_ragged(path + 'train.' + src)
+    train_trg_texts, trg_words = load_ragged(path + 'train.' + trg)
+
+    src_vocabs, src_lut = build_vocabs(train_src_texts, src_words, num_words)
+    trg_vocabs, trg_lut = build_vocabs(train_trg_texts, trg_words, num_words)
+
+    parts = {}
+    for split in SATED_SPLITS:
+        parts[split + '.src'] = encode_texts(load_ragged(path + split + '.' + src)[0], src_lut)
+        parts[split + '.trg'] = encode_texts(load_ragged(path + split + '.' + trg)[0], trg_lut)
+    return parts, {'src': src_vocabs, 'trg': trg_vocabs}
+
+
+def load_sated_data(num_words=10000, pair='en-fr'):
+    path = sated_path(pair)
+    key = split_key('full', [num_words], [], path)
+    split = load_split(key, path)
+    if split is None:
+        split = build_full_split(num_words, path)
+        save_split(key, *split, path=path)
+
+    parts, vocabs = split
+    return parts['train.src'], parts['train.trg'], parts['dev.src'], parts['dev.trg'], parts['test.src'], \
+           parts['test.trg'], vocabs['src'], vocabs['trg']
+
+
+def build_user_split(index, train_users, test_users=None, num_words=10000, user_data_ratio=0., dev_test=False,
+                     path=SATED_PATH):
+    src, trg = sated_langs(path)
+    user_src_texts = load_user_texts(train_users, path + 'train.' + src, index)
+    user_trg_texts = load_user_texts(train_users, path + 'train.' + trg, index)
 
-    test_src_texts = load_texts(SATED_TEST_ENG)
-    test_trg_texts = load_texts(SATED_TEST_FR)
-
-    src_words = list(chain(*train_src_texts))
-    trg_words = list(chain(*train_trg_texts))
+    if 0. < user_data_ratio < 1.:
+        # held out some fraction of data for testing
+        for u in user_src_texts:
+            l = len(user_src_texts[u])
+            # print l
+            l = int(l * user_data_ratio)
+            user_src_texts[u] = user_src_texts[u][:l]
+            user_trg_texts[u] = user_trg_texts[u][:l]
 
-    src_vocabs = process_vocabs(src_words, num_words)
-    trg_vocabs = process_vocabs(trg_words, num_words)
+    src_words = load_ragged(path + 'train.' + src)[1]
+    trg_words = load_ragged(path + 'train.' + trg)[1]
+    src_vocabs, src_lut = build_vocabs(RaggedArray.concatenate(user_src_texts.values()), src_words, num_words)
+    trg_vocabs, trg_lut = build_vocabs(RaggedArray.concatenate(user_trg_texts.values()), trg_words, num_words)
 
-    process_texts(train_src_texts, src_vocabs)
-    process_texts(train_trg_texts, trg_vocabs)
+    parts = {'train.src': encode_user_texts(user_src_texts, src_lut),
+             'train.trg': encode_user_texts(user_trg_texts, trg_lut)}
 
-    process_texts(dev_src_texts, src_vocabs)
-    process_texts(dev_trg_texts, trg_vocabs)
+    if dev_test:
+        for split in ('dev', 'test'):
+            parts[split + '.src'] = encode_texts(load_ragged(path + split + '.' + src)[0], src_lut)
+            parts[split + '.trg'] = encode_texts(load_ragged(path + split + '.' + trg)[0], trg_lut)
 
-    process_texts(test_src_texts, src_vocabs)
-    process_texts(test_trg_texts, trg_vocabs)
+    if test_users is not None:
+        parts['test_user.src'] = encode_user_texts(load_user_texts(test_users, path + 'train.' + src, index), src_lut)
+        parts['test_user.trg'] = encode_user_texts(load_user_texts(test_users, path + 'train.' + trg, index), trg_lut)
 
-    src_words = list(chain(*train_src_texts))
-    trg_words = list(chain(*train_trg_texts))
+    return parts, {'src': src_vocabs, 'trg': trg_vocabs}
 
-    src_vocabs = process_vocabs(src_words, None)
-    trg_vocabs = process_vocabs(trg_words, None)
 
-    return train_src_texts, train_trg_texts, dev_src_texts, dev_trg_texts, test_src_texts, test_trg_texts, \
-           src_vocabs, trg_vocabs
+def load_user_split(kind, params, index, train_users, test_users=None, num_words=10000, user_data_ratio=0.,
+                    dev_test=False, path=SATED_PATH):
+    # built once per (params, users, sources) and then read back from the compiled split artifact
+    key = split_key(kind, params, train_users, path)
+    split = load_split(key, path)
+    if split is None:
+        split = build_user_split(index, train_users, test_users, num_words, user_data_ratio, dev_test, path)
+        save_split(key, *split, path=path)
+    return split
 
 
 def load_sated_data_by_user(num_users=100, num_words=10000, test_on_user=False, sample_user=False,
-                            seed=12345, user_data_ratio=0.):
-    src_users = load_users(SATED_TRAIN_USER)
-    train_src_texts = load_texts(SATED_TRAIN_ENG)
-    train_trg_texts = load_texts(SATED_TRAIN_FR)
+                            seed=12345, user_data_ratio=0., pair='en-fr', train_users=None):
+    # train_users: the users of an earlier sample_user run, e.g. to resume training a shadow model
+    # texts come back as RaggedArrays already encoded against the returned vocabs
+    path = sated_path(pair)
+    index = load_user_index(path, seed)
 
-    dev_src_texts = load_texts(SATED_DEV_ENG)
-    dev_trg_texts = load_texts(SATED_DEV_FR)
-
-    test_src_texts = load_texts(SATED_TEST_ENG)
-    test_trg_texts = load_texts(SATED_TEST_FR)
-
-    user_counter = Counter(src_users)
-    all_users = [tup[0] for tup in user_counter.most_common()]
+    all_users = list(index['users'])
     # print len(all_users)
-    np.random.seed(seed)
-    np.random.shuffle(all_users)
-    np.random.seed(None)
 
-    train_users = set(all_users[:num_users])
     test_users = set(all_users[num_users: num_users * 2])
 
-    if sample_user:
+    if train_users is not None:
+        train_users = list(train_users)
+    elif sample_user:
         attacker_users = all_users[num_users * 2: num_users * 4]
         # np.random.seed(None)
         train_users = np.random.choice(attacker_users, size=num_users, replace=False)
         print(len(train_users))
         print(train_users[:10])
+    else:
+        train_users = set(all_users[:num_users])
 
-    user_src_texts = defaultdict(list)
-    user_trg_texts = defaultdict(list)
-
-    test_user_src_texts = defaultdict(list)
-    test_user_trg_texts = defaultdict(list)
-
-    for u, s, t in zip(src_users, train_src_texts, train_trg_texts):
-        if u in train_users:
-            user_src_texts[u].append(s)
-            user_trg_texts[u].append(t)
-        if test_on_user and u in test_users:
-            test_user_src_texts[u].append(s)
-            test_user_trg_texts[u].append(t)
-
-    if 0. < user_data_ratio < 1.:
-        # held out some fraction of data for testing
-        for u in user_src_texts:
-            l = len(user_src_texts[u])
-            # print l
-            l = int(l * user_data_ratio)
-            user_src_texts[u] = user_src_texts[u][:l]
-            user_trg_texts[u] = user_trg_texts[u][:l]
-
-    src_words = []
-    trg_words = []
-    for u in train_users:
-        src_words += list(chain(*user_src_texts[u]))
-        trg_words += list(chain(*user_trg_texts[u]))
-
-    src_vocabs = process_vocabs(src_words, num_words)
-    trg_vocabs = process_vocabs(trg_words, num_words)
-
-    for u in train_users:
-        process_texts(user_src_texts[u], src_vocabs)
-        process_texts(user_trg_texts[u], trg_vocabs)
+    params = [num_users, num_words, test_on_user, seed, user_data_ratio]
+    parts, vocabs = load_user_split('by_user', params, index, train_users, test_users if test_on_user else None,
+                                    num_words, user_data_ratio, dev_test=not test_on_user, path=path)
 
     if test_on_user:
-        for u in test_users:
-            process_texts(test_user_src_texts[u], src_vocabs)
-            process_texts(test_user_trg_texts[u], trg_vocabs)
+        return parts['train.src'], parts['train.trg'], parts['test_user.src'], parts['test_user.trg'], \
+               vocabs['src'], vocabs['trg']
+    else:
+        return parts['train.src'], parts['train.trg'], parts['dev.src'], parts['dev.trg'], parts['test.src'], \
+               parts['test.trg'], vocabs['src'], vocabs['trg']
 
-    process_texts(dev_src_texts, src_vocabs)
-    process_texts(dev_trg_texts, trg_vocabs)
 
-    process_texts(test_src_texts, src_vocabs)
-    process_texts(test_trg_texts, trg_vocabs)
+def sated_base_users(num_users=100, seed=12345, pair='en-fr'):
+    # users after the target's train/test users and the attacker pool the shadow models sample from, for a
+    # base model shared by the shadow models
+    index = load_user_index(sated_path(pair), seed)
+    return list(index['users'])[num_users * 4: num_users * 5]
 
-    src_words = []
-    trg_words = []
-    for u in train_users:
-        src_words += list(chain(*user_src_texts[u]))
-        trg_words += list(chain(*user_trg_texts[u]))
 
-    src_vocabs = process_vocabs(src_words, None)
-    trg_vocabs = process_vocabs(trg_words, None)
+def prepare_sated_pair(args):
+    pair, num_words, seed = args
+    path = sated_path(pair)
+    if load_sated_corpus(path) is None:
+        return pair, None
+    load_user_index(path, seed)
+    src_vocabs, trg_vocabs = load_sated_data(num_words, pair)[-2:]
+    return pair, (len(src_vocabs), len(trg_vocabs))
 
-    if test_on_user:
-        return user_src_texts, user_trg_texts, test_user_src_texts, test_user_trg_texts,  src_vocabs, trg_vocabs
-    else:
-        return user_src_texts, user_trg_texts, dev_src_texts, dev_trg_texts, test_src_texts, test_trg_texts,\
-               src_vocabs, trg_vocabs
+
+def prepare_sated_pairs(pairs=SATED_PAIRS, num_words=10000, seed=12345, processes=None):
+    # compiles the corpus, user index and full vocabulary of every language pair, one worker per pair
+    with Pool(processes or len(pairs)) as pool:
+        for pair, sizes in pool.imap_unordered(prepare_sated_pair, [(pair, num_words, seed) for pair in pairs]):
+            if sizes is None:
+                print('Skipping {}: SATED sources missing under {}'.format(pair, sated_path(pair)))
+            else:
+                print('Prepared {}: {} source and {} target vocabs'.format(pair, *sizes))
 
 
 # def read_europarl_file(filename, num_lines=80000):
@@ -251,4 +684,11 @@ def load_sated_data_by_user(num_users=100, num_words=10000, test_on_user=False,
 
 
 if __name__ == '__main__':
-    load_sated_data_by_user(num_users=300, sample_user=False)
+    if sys.argv[1:] == ['prepare']:
+        prepare_sated_pairs()
+    elif sys.argv[1:] == ['clean']:
+        # drops every compiled user split; they are rebuilt on demand
+        for pair in SATED_PAIRS:
+            print('Removed {} compiled splits of {}'.format(prune_splits(sated_path(pair), max_bytes=0), pair))
+    else:
+        load_sated_data_by_user(num_users=300, sample_user=False)
@@ -27,6 +27,22 @@ class Decoder(tf.keras.Model):
         x = self.fc(output)
         return x, state, attention_weights
 
+    def teacher_forcing(self, x, hidden, enc_output):
+        # logits for every step of the teacher-forced inputs x in one symbolic loop instead of one call per
+        # step. The first step goes through call() so the layers are built outside the loop; after that the
+        # embeddings and the encoder side of the attention are computed once and the output layer runs once.
+        first, hidden, _ = self.call(x[:, :1], hidden, enc_output)
+        keys = self.attention.W2(enc_output)
+        zeros = tf.zeros_like(hidden)
+
+        def step(hidden, x_t):
+            context_vector, _ = self.attention(hidden, enc_output, keys)
+            state, _ = self.gru.cell(tf.concat([context_vector, x_t], axis=-1), [zeros])
+            return state
+
+        states = tf.scan(step, tf.transpose(self.embedding(x[:, 1:]), [1, 0, 2]), initializer=hidden)
+        return tf.concat([tf.expand_dims(first, 1), self.fc(tf.transpose(states, [1, 0, 2]))], axis=1)
+
 
 class Encoder(tf.keras.Model):
     def __init__(self, vocab_size, batch_sz):
@@ -55,10 +71,13 @@ class BahdanauAttention(tf.keras.layers.Layer):
         self.W2 = tf.keras.layers.Dense(units)
         self.V = tf.keras.layers.Dense(1)
 
-    def call(self, query, values):
+    def call(self, query, values, keys=None):
+        # keys: W2(values), when computed once for several queries
+        if keys is None:
+            keys = self.W2(values)
         query_with_time_axis = tf.expand_dims(query, 1)
         score = self.V(tf.nn.tanh(
-            self.W1(query_with_time_axis) + self.W2(values)))
+            self.W1(query_with_time_axis) + keys))
         attention_weights = tf.nn.softmax(score, axis=1)
         context_vector = attention_weights * values
         context_vector = tf.reduce_sum(context_vector, axis=1)
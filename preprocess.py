@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+
+import io
+import os
+import re
+import unicodedata
+from multiprocessing import get_context
+
+PREPROCESS_CHUNK_SIZE = 1024
+
+
+def unicode_to_ascii(s):
+    return ''.join(c for c in unicodedata.normalize('NFD', s)
+                   if unicodedata.category(c) != 'Mn')
+
+
+def preprocess_sentence(w):
+    w = unicode_to_ascii(w.lower().strip())
+    w = re.sub(r"([?.!,¿])", r" \1 ", w)
+    w = re.sub(r'[" "]+', " ", w)
+    w = re.sub(r"[^a-zA-Z?.!,¿]+", " ", w)
+    w = w.strip()
+    w = '<start> ' + w + ' <end>'
+    return w
+
+
+def read_lines(path, num_examples=None):
+    # Same lines as io.open(path).read().strip().split('\n')[:num_examples], but stops reading after
+    # num_examples lines. Leading whitespace of the file is skipped; blank lines and the trailing whitespace
+    # of a line are only known to be the end of the file once the next non-blank line (or EOF) is read.
+    if num_examples is not None and num_examples < 0:
+        return io.open(path, encoding='UTF-8').read().strip().split('\n')[:num_examples]
+
+    lines = []
+    last = None
+    blank = []
+    with io.open(path, encoding='UTF-8') as f:
+        for line in f:
+            if num_examples is not None and len(lines) >= num_examples:
+                return lines[:num_examples]
+            if line.endswith('\n'):
+                line = line[:-1]
+
+            if last is None:
+                last = line.lstrip() or None
+            elif not line.strip():
+                blank.append(line)
+            else:
+                lines.append(last)
+                lines.extend(blank)
+                last = line
+                blank = []
+
+    lines.append('' if last is None else last.rstrip())
+    return lines[:num_examples]
+
+
+def preprocess_sentences(sentences, processes=1, chunksize=PREPROCESS_CHUNK_SIZE):
+    # preprocess_sentence over a list, each distinct sentence once. With processes > 1 (or None for one per
+    # core) large lists are fanned out to a pool of spawned workers, which re-import the calling script:
+    # only opt in from code under an `if __name__ == '__main__':` guard.
+    unique = list(dict.fromkeys(sentences))
+    processes = processes or os.cpu_count() or 1
+    if processes == 1 or len(unique) < chunksize:
+        processed = [preprocess_sentence(s) for s in unique]
+    else:
+        with get_context('spawn').Pool(processes) as pool:
+            processed = pool.map(preprocess_sentence, unique, chunksize)
+
+    lookup = dict(zip(unique, processed))
+    return [lookup[s] for s in sentences]
@@ -0,0 +1,99 @@
+from itertools import chain
+
+import numpy as np
+
+
+class RaggedArray:
+    # Rows of variable length stored as one flat `values` array plus int64 `offsets` (len(self) + 1 entries,
+    # offsets[0] == 0). Slicing with a step-1 slice returns a view that shares `values`.
+    def __init__(self, values, offsets):
+        self.values = values
+        self.offsets = offsets
+
+    @classmethod
+    def from_lists(cls, lists, dtype=np.int32):
+        offsets = np.zeros(len(lists) + 1, dtype=np.int64)
+        np.cumsum(np.fromiter((len(l) for l in lists), dtype=np.int64, count=len(lists)), out=offsets[1:])
+        values = np.fromiter(chain.from_iterable(lists), dtype=dtype, count=int(offsets[-1]))
+        return cls(values, offsets)
+
+    @classmethod
+    def from_padded(cls, padded):
+        # rows of a post-padded id matrix, 0 being the padding id
+        padded = np.asarray(padded)
+        mask = padded != 0
+        offsets = np.zeros(len(padded) + 1, dtype=np.int64)
+        np.cumsum(mask.sum(axis=1), out=offsets[1:])
+        return cls(padded[mask], offsets)
+
+    @classmethod
+    def concatenate(cls, arrays, dtype=np.int32):
+        arrays = list(arrays)
+        if not arrays:
+            return cls(np.zeros(0, dtype=dtype), np.zeros(1, dtype=np.int64))
+        values = np.concatenate([a.values for a in arrays])
+        offsets = [np.zeros(1, dtype=np.int64)]
+        start = 0
+        for a in arrays:
+            offsets.append(a.offsets[1:] + start)
+            start += a.offsets[-1]
+        return cls(values, np.concatenate(offsets))
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    @property
+    def lengths(self):
+        return np.diff(self.offsets)
+
+    def __getitem__(self, item):
+        if isinstance(item, (int, np.integer)):
+            if item < 0:
+                item += len(self)
+            return self.values[self.offsets[item]:self.offsets[item + 1]]
+
+        if isinstance(item, slice):
+            start, stop, step = item.indices(len(self))
+            if step == 1:
+                stop = max(start, stop)
+                offsets = self.offsets[start:stop + 1]
+                return RaggedArray(self.values[offsets[0]:offsets[-1]], offsets - offsets[0])
+            item = np.arange(start, stop, step)
+
+        rows = np.asarray(item)
+        if rows.dtype == bool:
+            rows = np.flatnonzero(rows)
+        rows = rows.astype(np.int64)
+        starts = self.offsets[rows]
+        lengths = self.offsets[rows + 1] - starts
+        offsets = np.zeros(len(rows) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        flat = np.repeat(starts - offsets[:-1], lengths) + np.arange(offsets[-1])
+        return RaggedArray(self.values[flat], offsets)
+
+    def map(self, lut):
+        # lookup-table remap of every token, e.g. corpus ids -> vocabulary ids
+        return RaggedArray(np.asarray(lut)[self.values], self.offsets)
+
+    def to_padded(self, length=None, dtype=np.int32, value=0, left=False):
+        # [len(self), length] matrix filled with `value` after (or before, with left=True) each row;
+        # length defaults to the longest row
+        lengths = self.lengths
+        if length is None:
+            length = int(lengths.max()) if len(lengths) else 0
+        padded = np.full((len(self), length), value, dtype=dtype)
+        if left:
+            filled = np.arange(length) >= (length - lengths)[:, None]
+        else:
+            filled = np.arange(length) < lengths[:, None]
+        padded[filled] = self.values[:self.offsets[-1]]
+        return padded
+
+    def tolist(self):
+        values = self.values.tolist()
+        offsets = self.offsets.tolist()
+        return [values[start:end] for start, end in zip(offsets[:-1], offsets[1:])]
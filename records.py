@@ -0,0 +1,32 @@
+import numpy as np
+
+from bundle import save_bundle, load_bundle
+from ragged import RaggedArray
+
+
+def save_records(path, splits, max_length_inp, max_length_targ):
+    # splits: name -> (padded inputs, padded labels). Records are stored unpadded, split after split,
+    # with the split of every record alongside.
+    names = list(splits)
+    inputs = RaggedArray.concatenate(RaggedArray.from_padded(splits[name][0]) for name in names)
+    labels = RaggedArray.concatenate(RaggedArray.from_padded(splits[name][1]) for name in names)
+    split = np.concatenate([np.full(len(splits[name][0]), i, dtype=np.int8) for i, name in enumerate(names)])
+
+    save_bundle(path, {'inputs.values': inputs.values, 'inputs.offsets': inputs.offsets,
+                       'labels.values': labels.values, 'labels.offsets': labels.offsets, 'split': split},
+                meta={'splits': names, 'max_length_inp': int(max_length_inp),
+                      'max_length_targ': int(max_length_targ)})
+
+
+def load_records(path):
+    # name -> (inputs, labels) as mmap-backed RaggedArrays, plus the padded lengths used in training
+    arrays, meta = load_bundle(path)
+    inputs = RaggedArray(arrays['inputs.values'], arrays['inputs.offsets'])
+    labels = RaggedArray(arrays['labels.values'], arrays['labels.offsets'])
+    split = np.asarray(arrays['split'])
+
+    records = {}
+    for i, name in enumerate(meta['splits']):
+        start, end = np.searchsorted(split, i), np.searchsorted(split, i, side='right')
+        records[name] = inputs[start:end], labels[start:end]
+    return records, meta
@@ -1,5 +1,12 @@
+import inspect
+import json
+import os
+import shutil
+import time
 from collections import defaultdict
+from multiprocessing import get_context
 
+import h5py
 import tensorflow as tf
 import numpy as np
 from tensorflow.keras import Model
@@ -8,35 +15,108 @@ from tensorflow.keras.layers import Input, Embedding, LSTM, Dropout, Dense, Add
 from tensorflow.keras.optimizers import Adam, SGD
 from tensorflow.keras.regularizers import l2
 
-from load_sated import load_sated_data_by_user
-from helper import DenseTransposeTied, Attention
+from bundle import save_bundle, load_bundle, encode_strings, decode_strings
+from load_sated import load_sated_data_by_user, sated_base_users
+from helper import DenseTransposeTied, Attention, LazyAdam
+from ragged import RaggedArray
+from train import restore_checkpoint
 
 MODEL_PATH = 'checkpoints/sated/model/'
+# (vocabulary, axis) of the weights indexed by word, for warm starts across vocabularies
+VOCAB_AXES = {'encoder_emb': ('src', 0), 'decoder_emb': ('trg', 0), 'outputs': ('trg', -1),
+              'context_outputs': ('trg', -1)}
+GATED_LAYERS = ('encoder_rnn', 'decoder_rnn')
 OUTPUT_PATH = 'checkpoints/sated/output/'
+ID_SPEC = tf.TensorSpec((None, None), tf.int32)
+# decoder steps the attention scores at once, which bounds its memory; any size gives the same results
+ATTN_TILE_SIZE = 8
 
-tf.compat.v1.disable_eager_execution()
 
+def pack_bucket(bucket, src_lens, trg_lens, max_tokens):
+    # (source, target) length order, then batches as large as fit in max_tokens padded tokens
+    bucket = np.random.permutation(bucket)
+    bucket = bucket[np.lexsort((trg_lens[bucket], src_lens[bucket]))]
 
-def group_texts_by_len(src_texts, trg_texts, bs=20):
-    print("Bucketing batches")
+    batches = []
+    batch = []
+    src_max = trg_max = 0
+    for i, src_len, trg_len in zip(bucket.tolist(), src_lens[bucket].tolist(), trg_lens[bucket].tolist()):
+        src_max, trg_max = max(src_max, src_len), max(trg_max, trg_len)
+        if batch and (len(batch) + 1) * (src_max + trg_max) > max_tokens:
+            batches.append(batch)
+            batch = []
+            src_max, trg_max = src_len, trg_len
+        batch.append(i)
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def group_rows_by_len(src_lens, trg_lens, bs=20, max_tokens=None, boundaries=None):
+    # With max_tokens, batch sizes follow a padded token budget instead of bs. boundaries (sorted source
+    # lengths) merge source lengths into ranges; by default every source length is its own bucket.
     # Bucket samples by source sentence length
+    keys = src_lens if boundaries is None else np.searchsorted(boundaries, src_lens, side='right')
     buckets = defaultdict(list)
     batches = []
-    for src, trg in zip(src_texts, trg_texts):
-        buckets[len(src)].append((src, trg))
-
-    for src_len, bucket in buckets.items():
-        np.random.shuffle(bucket)
-        num_batches = int(np.ceil(len(bucket) * 1.0 / bs))
-        for i in range(num_batches):
-            cur_batch_size = bs if i < num_batches - 1 else len(bucket) - bs * i
-            batches.append(([bucket[i * bs + j][0] for j in range(cur_batch_size)],
-                            [bucket[i * bs + j][1] for j in range(cur_batch_size)]))
+    for i, key in enumerate(keys.tolist()):
+        buckets[key].append(i)
+
+    for key, bucket in buckets.items():
+        if max_tokens is None:
+            np.random.shuffle(bucket)
+            for i in range(0, len(bucket), bs):
+                batches.append(bucket[i:i + bs])
+        else:
+            batches.extend(pack_bucket(bucket, src_lens, trg_lens, max_tokens))
+
+    if max_tokens is not None:
+        np.random.shuffle(batches)
     return batches
 
 
+def group_texts_by_len(src_texts, trg_texts, bs=20, max_tokens=None, boundaries=None):
+    print("Bucketing batches")
+    batches = group_rows_by_len(src_texts.lengths, trg_texts.lengths, bs, max_tokens, boundaries)
+    return [(src_texts[batch], trg_texts[batch]) for batch in batches]
+
+
+def make_dataset(src_texts, trg_texts, batches, src_eos=0, trg_eos=0, mask=True, shuffle=False, cache=False,
+                 label_mask=False):
+    # (src_input, trg_input, trg_label) batches of the given rows as a tf.data pipeline: padding runs in
+    # parallel map calls and prefetch overlaps it with the model step. With label_mask, targets are padded
+    # on the right, where the causal decoder cannot see the padding, and a float mask of the real labels
+    # is added.
+    def pad_batch(i):
+        rows = batches[i]
+        src_batch = pad_texts(src_texts[rows], src_eos, mask=mask)
+        if not label_mask:
+            trg_batch = pad_texts(trg_texts[rows], trg_eos, mask=mask)
+            return src_batch, trg_batch[:, :-1], trg_batch[:, 1:]
+
+        trg_batch = trg_texts[rows]
+        weights = np.arange(trg_batch.lengths.max() - 1) < (trg_batch.lengths - 1)[:, None]
+        trg_batch = trg_batch.to_padded(value=0 if mask else trg_eos)
+        return src_batch, trg_batch[:, :-1], trg_batch[:, 1:], weights.astype(np.float32)
+
+    def map_fn(i):
+        dtypes = (tf.int32, tf.int32, tf.int32, tf.float32) if label_mask else (tf.int32, tf.int32, tf.int32)
+        tensors = tf.numpy_function(pad_batch, [i], dtypes)
+        for t in tensors:
+            t.set_shape((None, None))
+        return tensors
+
+    dataset = tf.data.Dataset.range(len(batches))
+    dataset = dataset.map(map_fn, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+    if cache:
+        dataset = dataset.cache()
+    if shuffle:
+        dataset = dataset.shuffle(len(batches))
+    return dataset.prefetch(tf.data.experimental.AUTOTUNE)
+
+
 def build_nmt_model(Vs, Vt, demb=128, h=128, drop_p=0.5, tied=True, mask=True, attn=True, l2_ratio=1e-4,
-                    training=None, rnn_fn='lstm'):
+                    training=None, rnn_fn='lstm', attn_tile_size=ATTN_TILE_SIZE):
     if rnn_fn == 'lstm':
         rnn = LSTM
     elif rnn_fn == 'gru':
@@ -45,7 +125,7 @@ def build_nmt_model(Vs, Vt, demb=128, h=128, drop_p=0.5, tied=True, mask=True, a
         raise ValueError(rnn_fn)
 
     # build encoder
-    encoder_input = Input((None,), dtype='float32', name='encoder_input')
+    encoder_input = Input((None,), dtype='int32', name='encoder_input')
     if mask:
         encoder_emb_layer = Embedding(Vs + 1, demb, mask_zero=True, embeddings_regularizer=l2(l2_ratio),
                                       name='encoder_emb')
@@ -65,7 +145,7 @@ def build_nmt_model(Vs, Vt, demb=128, h=128, drop_p=0.5, tied=True, mask=True, a
     encoder_states = encoder_rtn[1:]
 
     # build decoder
-    decoder_input = Input((None,), dtype='float32', name='decoder_input')
+    decoder_input = Input((None,), dtype='int32', name='decoder_input')
     if mask:
         decoder_emb_layer = Embedding(Vt + 1, demb, mask_zero=True, embeddings_regularizer=l2(l2_ratio),
                                       name='decoder_emb')
@@ -92,7 +172,7 @@ def build_nmt_model(Vs, Vt, demb=128, h=128, drop_p=0.5, tied=True, mask=True, a
 
     if attn:
         contexts = Attention(units=h, kernel_regularizer=l2(l2_ratio), name='attention',
-                             use_bias=False)([encoder_outputs, decoder_outputs])
+                             use_bias=False, tile_size=attn_tile_size)([encoder_outputs, decoder_outputs])
         if drop_p > 0.:
             contexts = Dropout(drop_p)(contexts, training=training)
 
@@ -109,7 +189,7 @@ def build_inference_decoder(mask=False, demb=128, h=128, Vt=5000, tied=True, att
     rnn = LSTM
 
     # build decoder
-    decoder_input = Input(batch_shape=(None, None), dtype='float32', name='decoder_input')
+    decoder_input = Input(batch_shape=(None, None), dtype='int32', name='decoder_input')
     encoder_outputs = Input(batch_shape=(None, None, h), dtype='float32', name='encoder_outputs')
     encoder_h = Input(batch_shape=(None, h), dtype='float32', name='encoder_h')
     encoder_c = Input(batch_shape=(None, h), dtype='float32', name='encoder_c')
@@ -143,6 +223,9 @@ def build_inference_decoder(mask=False, demb=128, h=128, Vt=5000, tied=True, att
 
 
 def words_to_indices(data, vocab, mask=True):
+    if isinstance(data, RaggedArray):
+        # RaggedArrays from load_sated are already encoded against vocab
+        return RaggedArray(data.values + 1, data.offsets) if mask else data
     if mask:
         return [[vocab[w] + 1 for w in t] for t in data]
     else:
@@ -150,17 +233,89 @@ def words_to_indices(data, vocab, mask=True):
 
 
 def pad_texts(texts, eos, mask=True):
-    maxlen = max(len(t) for t in texts)
-    for t in texts:
-        while len(t) < maxlen:
-            if mask:
-                t.insert(0, 0)
-            else:
-                t.append(eos)
-    return np.asarray(texts, dtype='float32')
-
-
-def get_perp(user_src_data, user_trg_data, pred_fn, prop=1.0, shuffle=False):
+    # int32 batch written in one go: left-padded with 0 when masking, right-padded with <eos> otherwise
+    if not isinstance(texts, RaggedArray):
+        texts = RaggedArray.from_lists(texts)
+    return texts.to_padded(value=0 if mask else eos, left=mask)
+
+
+def nmt_loss(trg_label, prediction):
+    # summed over the target sentence, averaged over the batch; the regularizers were never part of it
+    loss = K.sparse_categorical_crossentropy(trg_label, prediction, from_logits=True)
+    return K.mean(K.sum(loss, axis=-1))
+
+
+def make_sampled_loss(model, num_sampled):
+    # sampled softmax version of nmt_loss. outputs and context_outputs together are one projection of the
+    # concatenated [decoder output, context] features, so this trains the same weights and the model still
+    # gives exact full-vocabulary logits. Vocab ids are in frequency order, as the log-uniform sampler assumes.
+    out_layer = model.get_layer('outputs')
+    layer_names = [layer.name for layer in model.layers]
+    feature_layers = [out_layer] + ([model.get_layer('context_outputs')] if 'context_outputs' in layer_names else [])
+    feature_model = Model(inputs=model.inputs, outputs=[layer.input for layer in feature_layers])
+
+    def sampled_loss(src_input, trg_input, trg_label):
+        features = feature_model([src_input, trg_input], training=True)
+        features = K.concatenate(features) if isinstance(features, list) else features
+        if isinstance(out_layer, DenseTransposeTied):
+            weights = [out_layer.tied_weights[0]]
+        else:
+            weights = [K.transpose(out_layer.kernel)]
+        weights += [K.transpose(layer.kernel) for layer in feature_layers[1:]]
+        num_classes = out_layer.units
+        biases = out_layer.bias if out_layer.bias is not None else tf.zeros((num_classes,))
+
+        loss = tf.nn.sampled_softmax_loss(K.concatenate(weights), biases,
+                                          labels=tf.reshape(tf.cast(trg_label, tf.int64), (-1, 1)),
+                                          inputs=tf.reshape(features, (-1, features.shape[-1])),
+                                          num_sampled=num_sampled, num_classes=num_classes)
+        return K.mean(K.sum(tf.reshape(loss, tf.shape(trg_label)), axis=-1))
+    return sampled_loss
+
+
+def train_step(model, optimizer, clipnorm, src_input, trg_input, trg_label, loss_fn=None):
+    # clipnorm is applied here as get_updates did, apply_gradients does not in TF 2.0
+    with tf.GradientTape() as tape:
+        if loss_fn is None:
+            loss = nmt_loss(trg_label, model([src_input, trg_input], training=True))
+        else:
+            loss = loss_fn(src_input, trg_input, trg_label)
+    grads = tape.gradient(loss, model.trainable_weights)
+    if clipnorm is not None:
+        grads = [tf.clip_by_norm(g, clipnorm) for g in grads]
+    optimizer.apply_gradients(zip(grads, model.trainable_weights))
+    return loss
+
+
+def make_train_fn(model, optimizer, clipnorm=None, num_sampled=None):
+    # num_sampled: train with a sampled softmax over that many negative words instead of the full one
+    loss_fn = make_sampled_loss(model, num_sampled) if num_sampled else None
+
+    @tf.function(input_signature=[ID_SPEC, ID_SPEC, ID_SPEC])
+    def train_fn(src_input, trg_input, trg_label):
+        return train_step(model, optimizer, clipnorm, src_input, trg_input, trg_label, loss_fn)
+    return train_fn
+
+
+def make_pred_fn(model):
+    # summed cross-entropy of the real labels of a batch
+    @tf.function(input_signature=[ID_SPEC, ID_SPEC, ID_SPEC, tf.TensorSpec((None, None), tf.float32)])
+    def pred_fn(src_input, trg_input, trg_label, label_mask):
+        loss = K.sparse_categorical_crossentropy(trg_label, model([src_input, trg_input], training=False),
+                                                 from_logits=True)
+        return K.sum(loss * label_mask)
+    return pred_fn
+
+
+def make_prob_fn(model):
+    @tf.function(input_signature=[ID_SPEC, ID_SPEC])
+    def prob_fn(src_input, trg_input):
+        return K.softmax(model([src_input, trg_input], training=False))
+    return prob_fn
+
+
+def get_perp(user_src_data, user_trg_data, pred_fn, prop=1.0, shuffle=False, bs=128):
+    # batches of equal source length, so only the targets need padding and it is masked out of the loss
     loss = 0.
     iters = 0.
 
@@ -170,23 +325,18 @@ def get_perp(user_src_data, user_trg_data, pred_fn, prop=1.0, shuffle=False):
     if shuffle:
         np.random.shuffle(indices)
 
-    for idx in indices[:n]:
-        src_text = np.asarray(user_src_data[idx], dtype=np.float32).reshape(1, -1)
-        trg_text = np.asarray(user_trg_data[idx], dtype=np.float32)
-        trg_input = trg_text[:-1].reshape(1, -1)
-        trg_label = trg_text[1:].reshape(1, -1)
-
-        err = pred_fn([src_text, trg_input, trg_label, 0])[0]
-
-        loss += err
-        iters += trg_label.shape[1]
+    indices = indices[:n]
+    batches = [indices[batch] for batch in group_rows_by_len(user_src_data.lengths[indices], None, bs=bs)]
+    for src_text, trg_input, trg_label, label_mask in make_dataset(user_src_data, user_trg_data, batches,
+                                                                   label_mask=True):
+        loss += pred_fn(src_text, trg_input, trg_label, label_mask).numpy()
+        iters += float(np.sum(label_mask))
 
     return loss, iters
 
 
-def train_sated_nmt(loo=0, num_users=200, num_words=5000, num_epochs=20, h=128, emb_h=128, l2_ratio=1e-4, exp_id=0,
-                    lr=0.001, batch_size=32, mask=False, drop_p=0.5, cross_domain=False, tied=False, ablation=False,
-                    sample_user=False, user_data_ratio=0., rnn_fn='lstm', optim_fn='adam'):
+def load_train_texts(num_users, num_words, loo=None, sample_user=False, user_data_ratio=0., mask=False,
+                     train_users=None, pair='en-fr'):
     # if cross_domain:
     #     sample_user = True
     #     user_src_texts, user_trg_texts, dev_src_texts, dev_trg_texts, test_src_texts, test_trg_texts,\
@@ -194,7 +344,8 @@ def train_sated_nmt(loo=0, num_users=200, num_words=5000, num_epochs=20, h=128,
     # else:
     user_src_texts, user_trg_texts, dev_src_texts, dev_trg_texts, test_src_texts, test_trg_texts, \
     src_vocabs, trg_vocabs = load_sated_data_by_user(num_users, num_words, sample_user=sample_user,
-                                                     user_data_ratio=user_data_ratio)
+                                                     user_data_ratio=user_data_ratio, pair=pair,
+                                                     train_users=train_users)
     train_src_texts, train_trg_texts = [], []
 
     users = sorted(user_src_texts.keys())
@@ -204,8 +355,11 @@ def train_sated_nmt(loo=0, num_users=200, num_words=5000, num_epochs=20, h=128,
         if loo is not None and i == loo:
             print("Leave user {} out".format(user))
             continue
-        train_src_texts += user_src_texts[user]
-        train_trg_texts += user_trg_texts[user]
+        train_src_texts.append(user_src_texts[user])
+        train_trg_texts.append(user_trg_texts[user])
+
+    train_src_texts = RaggedArray.concatenate(train_src_texts)
+    train_trg_texts = RaggedArray.concatenate(train_trg_texts)
 
     train_src_texts = words_to_indices(train_src_texts, src_vocabs, mask=mask)
     train_trg_texts = words_to_indices(train_trg_texts, trg_vocabs, mask=mask)
@@ -213,65 +367,202 @@ def train_sated_nmt(loo=0, num_users=200, num_words=5000, num_epochs=20, h=128,
     dev_trg_texts = words_to_indices(dev_trg_texts, trg_vocabs, mask=mask)
 
     print("Num train data {}, num test data {}".format(len(train_src_texts), len(dev_src_texts)))
+    return users, train_src_texts, train_trg_texts, dev_src_texts, dev_trg_texts, src_vocabs, trg_vocabs
 
-    Vs = len(src_vocabs)
-    Vt = len(trg_vocabs)
-    print(f"Source vocab len: {Vs}, Target vocab length: {Vt}")
-
-    print("Building NMT model...")
-    model = build_nmt_model(Vs=Vs, Vt=Vt, mask=mask, drop_p=drop_p, h=h, demb=emb_h, tied=tied, l2_ratio=l2_ratio,
-                            rnn_fn=rnn_fn)
-    src_input_var, trg_input_var = model.inputs
-    prediction = model.output
-
-    trg_label_var = K.placeholder((None, None), dtype='float32')
-
-    loss = K.sparse_categorical_crossentropy(trg_label_var, prediction, from_logits=True)
-    loss = K.mean(K.sum(loss, axis=-1))
 
+def make_optimizer(optim_fn, lr, weight_decay=0.):
+    # (optimizer, clipnorm); lazy_adam only updates the embedding rows a batch looks up, weight_decay is its
+    # optional decoupled decay
     if optim_fn == 'adam':
-        optimizer = Adam(learning_rate=lr, clipnorm=5.)
+        return Adam(learning_rate=lr), 5.
+    elif optim_fn == 'lazy_adam':
+        return LazyAdam(learning_rate=lr, weight_decay=weight_decay), 5.
     elif optim_fn == 'mom_sgd':
-        optimizer = SGD(learning_rate=lr, momentum=0.9)
+        return SGD(learning_rate=lr, momentum=0.9), None
     else:
         raise ValueError(optim_fn)
 
-    updates = optimizer.get_updates(loss, model.trainable_weights)
-
-    train_fn = K.function(inputs=[src_input_var, trg_input_var, trg_label_var, K.learning_phase()], outputs=[loss],
-                          updates=updates)
-    pred_fn = K.function(inputs=[src_input_var, trg_input_var, trg_label_var, K.learning_phase()], outputs=[loss])
-
-    # pad batches to same length
-    train_prop = 0.2
-    batches = []
-    for batch in group_texts_by_len(train_src_texts, train_trg_texts, bs=batch_size):
-        src_input, trg_input = batch
-        src_input = pad_texts(src_input, src_vocabs['<eos>'], mask=mask)
-        trg_input = pad_texts(trg_input, trg_vocabs['<eos>'], mask=mask)
-        batches.append((src_input, trg_input))
-
-    print(f"Number of batches: {len(batches)}\nFirst batch: {batches[0]}")
-
-    print("Training NMT model...")
-    for epoch in range(num_epochs):
-        print(f"On epoch {epoch} of training...")
-        np.random.shuffle(batches)
 
-        for batch in batches:
-            src_input, trg_input = batch
-            _ = train_fn([src_input, trg_input[:, :-1], trg_input[:, 1:], 1])[0]
-
-        train_loss, train_it = get_perp(train_src_texts, train_trg_texts, pred_fn, shuffle=True, prop=train_prop)
-        test_loss, test_it = get_perp(dev_src_texts, dev_trg_texts, pred_fn)
+def print_perp(epoch, pred_fn, train_src_texts, train_trg_texts, dev_src_texts, dev_trg_texts, train_prop=0.2):
+    # returns the test perplexity
+    train_loss, train_it = get_perp(train_src_texts, train_trg_texts, pred_fn, shuffle=True, prop=train_prop)
+    test_loss, test_it = get_perp(dev_src_texts, dev_trg_texts, pred_fn)
+
+    print("Epoch {}, train loss={:.3f}, train perp={:.3f}, test loss={:.3f}, test perp={:.3f}".format(
+        epoch,
+        train_loss / len(train_src_texts) / train_prop,
+        np.exp(train_loss / train_it),
+        test_loss / len(dev_src_texts),
+        np.exp(test_loss / test_it)))
+    return np.exp(test_loss / test_it)
+
+
+def nmt_model_path(fname, num_users, pair='en-fr'):
+    return MODEL_PATH + '{}_{}_{}.h5'.format(fname, pair, num_users)
+
+
+def shadow_id(exp_id, warm=False):
+    # warm started shadow models are kept apart from the ones trained from scratch, to compare the two
+    return '{}{}'.format(exp_id, '_warm' if warm else '')
+
+
+def shadow_users_path(exp_id, rnn_fn, num_users, cross_domain=False, pair='en-fr', warm=False):
+    return MODEL_PATH + 'shadow_users{}_{}_{}_{}_{}.npz'.format(shadow_id(exp_id, warm), rnn_fn, pair, num_users,
+                                                                'cd' if cross_domain else '')
+
+
+def save_shadow_users(users, exp_id, rnn_fn, num_users, cross_domain=False, pair='en-fr', warm=False):
+    users_path = shadow_users_path(exp_id, rnn_fn, num_users, cross_domain, pair, warm)
+    tmp_path = '{}.tmp{}'.format(users_path, os.getpid())
+    with open(tmp_path, 'wb') as f:
+        np.savez(f, users)
+    os.replace(tmp_path, users_path)
+    print(f"Shadow model {exp_id} saved to {users_path}.")
+
+
+def save_nmt_model(model, model_path):
+    # saved under a temporary name first so a sweep never leaves a partial model behind
+    tmp_path = '{}.tmp{}.h5'.format(model_path[:-3], os.getpid())
+    model.save(tmp_path)
+    os.replace(tmp_path, model_path)
+    print(f"Target model saved to {model_path}.")
+
+
+def save_nmt_vocabs(model_path, src_vocabs, trg_vocabs):
+    # word lists in id order, next to the model
+    arrays = {}
+    for name, vocabs in (('src', src_vocabs), ('trg', trg_vocabs)):
+        arrays[name + '_words'], arrays[name + '_offsets'] = encode_strings(sorted(vocabs, key=vocabs.get))
+    save_bundle(model_path[:-3] + '.vocab', arrays)
+
+
+def load_nmt_vocabs(model_path):
+    arrays, _ = load_bundle(model_path[:-3] + '.vocab')
+    return [{w: i for i, w in enumerate(decode_strings(arrays[name + '_words'], arrays[name + '_offsets']))}
+            for name in ('src', 'trg')]
+
+
+def load_h5_weights(model_path):
+    # layer name -> weights of a saved model, whatever its sizes
+    weights = {}
+    with h5py.File(model_path, 'r') as f:
+        group = f['model_weights'] if 'model_weights' in f else f
+        for layer in group.attrs['layer_names']:
+            layer = layer.decode('utf8') if isinstance(layer, bytes) else layer
+            names = [n.decode('utf8') if isinstance(n, bytes) else n for n in group[layer].attrs['weight_names']]
+            weights[layer] = [np.asarray(group[layer][n]) for n in names]
+    return weights
+
+
+def transfer_indices(layer, axis, ndim, base_size, size, vocab_maps):
+    # (base index, index) pairs to copy along one axis of a weight
+    if layer in VOCAB_AXES and VOCAB_AXES[layer][1] % ndim == axis:
+        base_rows, rows = vocab_maps[VOCAB_AXES[layer][0]]
+        keep = (base_rows < base_size) & (rows < size)
+        return base_rows[keep], rows[keep]
+    if layer in GATED_LAYERS and axis == ndim - 1:
+        # LSTM gates are stacked along the last axis; keep the first units of each gate
+        base_units, units = base_size // 4, size // 4
+        n = min(base_units, units)
+        return np.concatenate([g * base_units + np.arange(n) for g in range(4)]), \
+            np.concatenate([g * units + np.arange(n) for g in range(4)])
+    n = min(base_size, size)
+    return np.arange(n), np.arange(n)
+
+
+def warm_start(model, base_path, src_vocabs, trg_vocabs, mask=False):
+    # initializes model from a trained model of possibly other widths and vocabularies: rows of shared words
+    # are remapped to their ids here, and the overlapping slice of every other weight is copied
+    base_weights = load_h5_weights(base_path)
+    base_src_vocabs, base_trg_vocabs = load_nmt_vocabs(base_path)
+    offset = 1 if mask else 0
+    vocab_maps = {}
+    for name, base_vocabs, vocabs in (('src', base_src_vocabs, src_vocabs), ('trg', base_trg_vocabs, trg_vocabs)):
+        shared = [w for w in vocabs if w in base_vocabs]
+        vocab_maps[name] = (np.array([base_vocabs[w] for w in shared], dtype=np.int64) + offset,
+                            np.array([vocabs[w] for w in shared], dtype=np.int64) + offset)
+
+    for layer in model.layers:
+        if not layer.weights or layer.name not in base_weights:
+            continue
+        weights = []
+        for base, w, var in zip(base_weights[layer.name], layer.get_weights(), layer.weights):
+            if not var.name.startswith(layer.name + '/'):
+                # tied weights are transferred by the layer they belong to
+                weights.append(w)
+                continue
+            indices = [transfer_indices(layer.name, axis, w.ndim, base.shape[axis], w.shape[axis], vocab_maps)
+                       for axis in range(w.ndim)]
+            w = w.copy()
+            w[np.ix_(*[i[1] for i in indices])] = base[np.ix_(*[i[0] for i in indices])]
+            weights.append(w)
+        layer.set_weights(weights)
+    print(f"Warm started from {base_path}, {len(vocab_maps['src'][0])} source and {len(vocab_maps['trg'][0])} "
+          f"target words shared")
+
+
+def save_json(path, obj):
+    tmp_path = '{}.tmp{}'.format(path, os.getpid())
+    with open(tmp_path, 'w') as f:
+        json.dump(obj, f)
+    os.replace(tmp_path, path)
+
+
+def load_json(path):
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_training_info(model_path, info):
+    # settings, epochs actually trained and the best test perplexity, next to the model
+    save_json(model_path[:-3] + '.json', info)
+
+
+def load_training_info(model_path):
+    return load_json(model_path[:-3] + '.json')
+
+
+def train_config(**kwargs):
+    # every train_sated_nmt argument, defaults filled in and as it reads back from json. A model or checkpoint
+    # is only reused by a run with the same config.
+    args = inspect.signature(train_sated_nmt).bind(**kwargs)
+    args.apply_defaults()
+    # the attention tile size only bounds memory, a model is the same with any
+    args.arguments.pop('attn_tile_size')
+    return json.loads(json.dumps(args.arguments, default=lambda o: o.tolist() if hasattr(o, 'tolist') else str(o)))
+
+
+def is_trained(model_path, config):
+    if not os.path.exists(model_path):
+        return False
+    info = load_training_info(model_path)
+    if info is None or info.get('config') != config:
+        print(f"Retraining {model_path}, it was trained with other settings.")
+        return False
+    return True
+
+
+def prepare_checkpoint_dir(checkpoint_dir, config):
+    # checkpoints of an interrupted run with other settings cannot be resumed, they are dropped
+    config_path = os.path.join(checkpoint_dir, 'config.json')
+    if os.path.isdir(checkpoint_dir) and load_json(config_path) != config:
+        print(f"Discarding {checkpoint_dir}, it was written with other settings.")
+        shutil.rmtree(checkpoint_dir)
+    os.makedirs(checkpoint_dir, exist_ok=True)
+    save_json(config_path, config)
 
-        print("Epoch {}, train loss={:.3f}, train perp={:.3f}, test loss={:.3f}, test perp={:.3f}".format(
-            epoch,
-            train_loss / len(train_src_texts) / train_prop,
-            np.exp(train_loss / train_it),
-            test_loss / len(dev_src_texts),
-            np.exp(test_loss / test_it)))
 
+def train_sated_nmt(loo=0, num_users=200, num_words=5000, num_epochs=20, h=128, emb_h=128, l2_ratio=1e-4, exp_id=0,
+                    lr=0.001, batch_size=32, mask=False, drop_p=0.5, cross_domain=False, tied=False, ablation=False,
+                    sample_user=False, user_data_ratio=0., rnn_fn='lstm', optim_fn='adam', max_tokens=None,
+                    boundaries=None, patience=None, min_delta=0., base=False, init_from=None, num_sampled=None,
+                    weight_decay=0., attn_tile_size=ATTN_TILE_SIZE, pair='en-fr'):
+    # With patience, training stops once the test perplexity has not improved by more than min_delta for
+    # patience epochs, and the model is saved with the weights of its best epoch. base trains the shared
+    # base model on sated_base_users; init_from warm starts from such a model instead of a random init.
+    config = train_config(**locals())
     # if cross_domain:
     #     fname = 'europal_nmt{}'.format('' if loo is None else loo)
     # else:
@@ -284,16 +575,152 @@ def train_sated_nmt(loo=0, num_users=200, num_words=5000, num_epochs=20, h=128,
         fname += '_dr{}'.format(user_data_ratio)
 
     if sample_user:
-        fname += '_shadow_exp{}_{}'.format(exp_id, rnn_fn)
-        np.savez(
-            MODEL_PATH + 'shadow_users{}_{}_{}_{}.npz'.format(exp_id, rnn_fn, num_users, 'cd' if cross_domain else ''),
-            users
-        )
-        print(f"Shadow model {exp_id} saved to {MODEL_PATH + 'shadow_users{}_{}_{}_{}.npz'.format(exp_id, rnn_fn, num_users, 'cd' if cross_domain else '')}.")
-
-    model.save(MODEL_PATH + '{}_{}.h5'.format(fname, num_users))
-    print(f"Target model saved to {MODEL_PATH + '{}_{}.h5'.format(fname, num_users)}.")
+        fname += '_shadow_exp{}_{}'.format(shadow_id(exp_id, init_from is not None), rnn_fn)
+
+    if base:
+        fname += '_base_{}_h{}'.format(rnn_fn, h)
+
+    model_path = nmt_model_path(fname, num_users, pair)
+    if is_trained(model_path, config):
+        print(f"Skipping {model_path}, already trained.")
+        return model_path
+
+    # per-epoch checkpoints of an unfinished run; a resumed shadow model reuses the users it was sampled with
+    checkpoint_dir = model_path[:-3] + '_ckpt'
+    prepare_checkpoint_dir(checkpoint_dir, config)
+    train_users = None
+    if base:
+        train_users = sated_base_users(num_users, pair=pair)
+    elif sample_user and tf.train.latest_checkpoint(checkpoint_dir):
+        train_users = np.load(shadow_users_path(exp_id, rnn_fn, num_users, cross_domain, pair,
+                                                init_from is not None))['arr_0']
+
+    users, train_src_texts, train_trg_texts, dev_src_texts, dev_trg_texts, src_vocabs, trg_vocabs = \
+        load_train_texts(num_users, num_words, loo, sample_user, user_data_ratio, mask, train_users, pair)
+    if sample_user and train_users is None:
+        save_shadow_users(users, exp_id, rnn_fn, num_users, cross_domain, pair, init_from is not None)
+
+    Vs = len(src_vocabs)
+    Vt = len(trg_vocabs)
+    print(f"Source vocab len: {Vs}, Target vocab length: {Vt}")
+
+    print("Building NMT model...")
+    model = build_nmt_model(Vs=Vs, Vt=Vt, mask=mask, drop_p=drop_p, h=h, demb=emb_h, tied=tied, l2_ratio=l2_ratio,
+                            rnn_fn=rnn_fn, attn_tile_size=attn_tile_size)
+
+    if init_from is not None:
+        warm_start(model, init_from, src_vocabs, trg_vocabs, mask=mask)
+
+    optimizer, clipnorm = make_optimizer(optim_fn, lr, weight_decay)
+    train_fn = make_train_fn(model, optimizer, clipnorm, num_sampled)
+    pred_fn = make_pred_fn(model)
+
+    checkpoint = tf.train.Checkpoint(model=model, optimizer=optimizer, epoch=tf.Variable(0, dtype=tf.int64),
+                                     best_perp=tf.Variable(np.inf, dtype=tf.float64),
+                                     best_epoch=tf.Variable(-1, dtype=tf.int64),
+                                     train_time=tf.Variable(0., dtype=tf.float64))
+    checkpoint_manager = tf.train.CheckpointManager(checkpoint, checkpoint_dir, max_to_keep=1)
+    best_checkpoint = tf.train.Checkpoint(model=model)
+    best_manager = tf.train.CheckpointManager(best_checkpoint, checkpoint_dir + '/best', max_to_keep=1)
+
+    # batches are padded once in the first epoch, cached and reshuffled every epoch
+    batches = group_rows_by_len(train_src_texts.lengths, train_trg_texts.lengths, bs=batch_size,
+                                max_tokens=max_tokens, boundaries=boundaries)
+    train_data = make_dataset(train_src_texts, train_trg_texts, batches, src_vocabs['<eos>'], trg_vocabs['<eos>'],
+                              mask=mask, shuffle=True, cache=True)
+
+    print(f"Number of batches: {len(batches)}")
+    num_tokens = int(train_trg_texts.lengths.sum()) - len(train_trg_texts)
+
+    # train_time adds up the epochs of every run that worked on this model
+    print("Training NMT model...")
+    for epoch in range(restore_checkpoint(checkpoint, checkpoint_manager), num_epochs):
+        if patience is not None and epoch - 1 - int(checkpoint.best_epoch.numpy()) >= patience:
+            print(f"Stopping early, no improvement since epoch {int(checkpoint.best_epoch.numpy())}")
+            break
+        print(f"On epoch {epoch} of training...")
+
+        start = time.time()
+        for src_input, trg_input, trg_label in train_data:
+            _ = train_fn(src_input, trg_input, trg_label)
+        epoch_time = time.time() - start
+        print("Epoch {}, {:.1f} steps/sec, {:.0f} target tokens/sec".format(epoch, len(batches) / epoch_time,
+                                                                          num_tokens / epoch_time))
+        if isinstance(optimizer, LazyAdam):
+            optimizer.catch_up(model.trainable_weights)
+
+        test_perp = print_perp(epoch, pred_fn, train_src_texts, train_trg_texts, dev_src_texts, dev_trg_texts)
+        if test_perp < checkpoint.best_perp.numpy() - min_delta:
+            checkpoint.best_perp.assign(test_perp)
+            checkpoint.best_epoch.assign(epoch)
+            if patience is not None:
+                best_manager.save()
+
+        checkpoint.epoch.assign(epoch + 1)
+        checkpoint.train_time.assign_add(time.time() - start)
+        checkpoint_manager.save()
+
+    if patience is not None and best_manager.latest_checkpoint:
+        best_checkpoint.restore(best_manager.latest_checkpoint)
+        print(f"Restored the weights of epoch {int(checkpoint.best_epoch.numpy())}")
+
+    save_nmt_model(model, model_path)
+    save_nmt_vocabs(model_path, src_vocabs, trg_vocabs)
+    save_training_info(model_path, {'config': config, 'epochs': int(checkpoint.epoch.numpy()),
+                                    'best_epoch': int(checkpoint.best_epoch.numpy()),
+                                    'best_perp': float(checkpoint.best_perp.numpy()),
+                                    'train_time': float(checkpoint.train_time.numpy())})
+    shutil.rmtree(checkpoint_dir, ignore_errors=True)
     K.clear_session()
+    return model_path
+
+
+def init_sweep_worker(intra_threads, inter_threads):
+    tf.config.threading.set_intra_op_parallelism_threads(intra_threads)
+    tf.config.threading.set_inter_op_parallelism_threads(inter_threads)
+
+
+def run_sweep_job(kwargs):
+    start = time.time()
+    model_path = train_sated_nmt(**kwargs)
+    return kwargs, model_path, time.time() - start
+
+
+def train_sweep(jobs, processes=None):
+    # runs train_sated_nmt(**kwargs) for every job in a pool of fresh (spawned) TF processes, splitting the
+    # cores between them. Largest models go first so the long jobs do not end up last on one worker.
+    cores = os.cpu_count() or 1
+    processes = max(1, min(processes or cores, len(jobs)))
+    intra_threads = max(1, cores // processes)
+    inter_threads = min(2, intra_threads)
+    jobs = sorted(jobs, key=lambda kwargs: kwargs.get('h', 128) * kwargs.get('emb_h', 128), reverse=True)
+    print(f"Training {len(jobs)} models on {processes} workers with {intra_threads} threads each")
+
+    start = time.time()
+    results = []
+    with get_context('spawn').Pool(processes, init_sweep_worker, (intra_threads, inter_threads)) as pool:
+        for kwargs, model_path, wall_time in pool.imap_unordered(run_sweep_job, jobs):
+            print(f"Finished {model_path} in {wall_time:.1f} sec")
+            results.append((model_path, wall_time))
+
+    print("Sweep summary:")
+    for model_path, wall_time in sorted(results):
+        print(f"  {model_path}: {wall_time:.1f} sec")
+    print(f"Total {sum(t for _, t in results):.1f} sec of training in {time.time() - start:.1f} sec wall time")
+    return results
+
+
+def train_loo_family(loos, loo_epochs=5, processes=None, **kwargs):
+    # leave-one-user-out models for the users at the given indices: the full model is trained once (or reused)
+    # and every sated_nmt{loo} model fine-tunes it for loo_epochs without its user, in parallel
+    full_path = train_sated_nmt(**dict(kwargs, loo=None))
+    return train_sweep([dict(kwargs, loo=loo, num_epochs=loo_epochs, init_from=full_path) for loo in loos],
+                       processes)
+
+
+def training_time(model_paths):
+    # measured training seconds of the models, over all the runs that trained them
+    return sum(load_training_info(model_path)['train_time'] for model_path in model_paths)
 
 
 if __name__ == '__main__':
@@ -305,14 +732,32 @@ if __name__ == '__main__':
     rnn_fn = 'lstm'
     optim_fn = 'adam'
     num_users = 300
+    # SATED language pair (en-de, en-es or en-fr), part of every model, users and ranks file name
+    pair = 'en-fr'
     sample_user_flag = False
     cross_domain_flag = False
+    # epochs without a test perplexity improvement before stopping early; None always trains all epochs
+    patience = None
 
     print("Get target model...")
-    train_sated_nmt(exp_id=None, loo=None, sample_user=sample_user_flag,
-                    lr=lr, cross_domain=cross_domain_flag, h=128, emb_h=128,
-                    num_epochs=epochs, num_users=num_users, batch_size=batch_size,
-                    drop_p=0.5, rnn_fn=rnn_fn, optim_fn=optim_fn)
+    target_path = train_sated_nmt(exp_id=None, loo=None, sample_user=sample_user_flag,
+                                  lr=lr, cross_domain=cross_domain_flag, h=128, emb_h=128,
+                                  num_epochs=epochs, num_users=num_users, batch_size=batch_size,
+                                  drop_p=0.5, rnn_fn=rnn_fn, optim_fn=optim_fn, patience=patience, pair=pair)
+
+    # indices of the users to get leave-one-out models of, fine-tuned from the target model for loo_epochs
+    loo_users = []
+    loo_epochs = 5
+    if loo_users:
+        print("Get leave-one-out models...")
+        results = train_loo_family(loo_users, loo_epochs, exp_id=None, sample_user=sample_user_flag,
+                                   lr=lr, cross_domain=cross_domain_flag, h=128, emb_h=128,
+                                   num_epochs=epochs, num_users=num_users, batch_size=batch_size,
+                                   drop_p=0.5, rnn_fn=rnn_fn, optim_fn=optim_fn, patience=patience,
+                                   pair=pair)
+        print(f"Fine-tuning {len(results)} leave-one-out models took "
+              f"{training_time([model_path for model_path, _ in results]):.1f} sec of training, the full model "
+              f"{training_time([target_path]):.1f} sec")
 
     # Update hyperparameters for shadow models
     num_shadow_models = 10
@@ -323,11 +768,44 @@ if __name__ == '__main__':
     optim_fn = 'mom_sgd'
     sample_user_flag = True
     dims = list(range(64, 353, 32))
+    # also fine-tune a second set of shadow models for warm_epochs from one base model trained on users none of
+    # them sample, and compare its training time and attack AUC with the shadow models trained from scratch
+    warm_start_flag = False
+    warm_epochs = 10
 
     print("Get shadow models...")
-    for i in range(num_shadow_models):
-        print(f"Setting hidden/embedding dimension = {dims[i]} for shadow model {i}")
-        train_sated_nmt(exp_id=i, loo=None, sample_user=sample_user_flag,
-                        lr=lr, cross_domain=cross_domain_flag, h=dims[i], emb_h=dims[i],
-                        num_epochs=epochs, num_users=num_users, batch_size=batch_size,
-                        drop_p=0, rnn_fn=rnn_fn, optim_fn=optim_fn)
+    shadow_kwargs = dict(lr=lr, cross_domain=cross_domain_flag, num_users=num_users, batch_size=batch_size, drop_p=0,
+                         rnn_fn=rnn_fn, optim_fn=optim_fn, patience=patience, pair=pair)
+    shadow_jobs = [dict(shadow_kwargs, exp_id=i, loo=None, sample_user=sample_user_flag, h=dims[i], emb_h=dims[i],
+                        num_epochs=epochs) for i in range(num_shadow_models)]
+    shadow_paths = [model_path for model_path, _ in train_sweep(shadow_jobs)]
+
+    if warm_start_flag:
+        print("Get base model...")
+        base_path = train_sated_nmt(exp_id=None, loo=None, base=True, lr=lr, h=128, emb_h=128,
+                                    num_epochs=epochs, num_users=num_users, batch_size=batch_size,
+                                    drop_p=0, rnn_fn=rnn_fn, optim_fn=optim_fn, patience=patience, pair=pair)
+
+        print("Get warm started shadow models...")
+        warm_paths = [model_path for model_path, _ in
+                      train_sweep([dict(job, num_epochs=warm_epochs, init_from=base_path) for job in shadow_jobs])]
+
+        from sated_nmt_ranks import get_target_ranks, get_shadow_ranks
+        from sated_nmt_attacks import run_attack2
+
+        get_target_ranks(num_users=num_users, pair=pair)
+        aucs = {}
+        for warm in (False, True):
+            for i in range(num_shadow_models):
+                get_shadow_ranks(exp_id=i, num_users=num_users, rnn_fn=rnn_fn, h=dims[i], emb_h=dims[i], pair=pair,
+                                 warm=warm)
+            aucs[warm] = run_attack2(num_exp=num_shadow_models, num_users=num_users, rerun=True, pair=pair,
+                                     warm=warm)[1]
+
+        scratch_time = training_time(shadow_paths)
+        warm_time = training_time(warm_paths)
+        base_time = training_time([base_path])
+        print(f"From scratch: {scratch_time:.1f} sec of training, attack AUC {aucs[False]:.4f}")
+        print(f"Warm started: {warm_time + base_time:.1f} sec of training ({base_time:.1f} sec on the base model), "
+              f"attack AUC {aucs[True]:.4f}")
+        print(f"Warm start saved {scratch_time - warm_time - base_time:.1f} sec of training")
@@ -15,7 +15,7 @@ from helper import flatten_data
 from load_sated import process_texts, process_vocabs, load_texts, load_users, load_sated_data_by_user, \
     SATED_TRAIN_USER, SATED_TRAIN_FR, SATED_TRAIN_ENG
 from sated_nmt import build_nmt_model, words_to_indices, MODEL_PATH, OUTPUT_PATH
-from sated_nmt_ranks import get_target_ranks, get_shadow_ranks, ranks_to_feats
+from sated_nmt_ranks import get_target_ranks, get_shadow_ranks, ranks_to_feats, target_ranks_dir, shadow_ranks_dir
 
 
 # HELPER METHODS
@@ -167,20 +167,20 @@ def ranks_to_feats(ranks, labels=None, prop=1.0, dim=100, num_words=5000, top_wo
 # Attack 1: Average Rank Thresholding
 def run_attack1(num_users=5000, dim=100, prop=1.0, user_data_ratio=0., attacker_knowledge=0.5,
                 heldout_ratio=0., num_words=5000, top_words=5000, relative=False, rare=False,
-                norm=True, scale=True, cross_domain=False, rerun=False):
+                norm=True, scale=True, cross_domain=False, rerun=False, pair='en-fr'):
     result_path = OUTPUT_PATH
 
     if dim > top_words:
         dim = top_words
 
-    attack1_results_save_path = result_path + 'mi_data_dim{}_prop{}_{}{}_attack1.npz'.format(
-        dim, prop, num_users, '_cd' if cross_domain else '')
+    attack1_results_save_path = result_path + 'mi_data_dim{}_prop{}_{}_{}{}_attack1.npz'.format(
+        dim, prop, pair, num_users, '_cd' if cross_domain else '')
 
     if not rerun and os.path.exists(attack1_results_save_path):
         f = np.load(attack1_results_save_path)
         X_train, y_train, X_test, y_test = [f['arr_{}'.format(i)] for i in range(4)]
     else:
-        save_dir = result_path + 'target_{}{}/'.format(num_users, '_dr' if 0. < user_data_ratio < 1. else '')
+        save_dir = target_ranks_dir(num_users, user_data_ratio, pair)
         train_ranks, train_labels, train_y = load_ranks_by_label(save_dir, num_users, label=1)
         test_ranks, test_labels, test_y = load_ranks_by_label(save_dir, num_users, label=0)
 
@@ -230,21 +230,21 @@ def run_attack1(num_users=5000, dim=100, prop=1.0, user_data_ratio=0., attacker_
 # Attack 2: Shadow Models on Rank Histograms
 def run_attack2(num_exp=5, num_users=5000, dim=100, prop=1.0, user_data_ratio=0.,
                 heldout_ratio=0., num_words=5000, top_words=5000, relative=False, rare=False, norm=True,
-                scale=True, cross_domain=False, rerun=False):
-
+                scale=True, cross_domain=False, rerun=False, pair='en-fr', warm=False):
+    # warm: attack with the shadow models warm started from a base model
     result_path = OUTPUT_PATH
 
     if dim > top_words:
         dim = top_words
 
-    audit_save_path = result_path + 'mi_data_dim{}_prop{}_{}{}.npz'.format(
-        dim, prop, num_users, '_cd' if cross_domain else '')
+    audit_save_path = result_path + 'mi_data_dim{}_prop{}_{}_{}{}{}.npz'.format(
+        dim, prop, pair, num_users, '_cd' if cross_domain else '', '_warm' if warm else '')
 
     if not rerun and os.path.exists(audit_save_path):
         f = np.load(audit_save_path, allow_pickle=True)
         X_train, y_train, X_test, y_test = [f['arr_{}'.format(i)] for i in range(4)]
     else:
-        save_dir = result_path + 'target_{}{}/'.format(num_users, '_dr' if 0. < user_data_ratio < 1. else '')
+        save_dir = target_ranks_dir(num_users, user_data_ratio, pair)
         ranks, labels, y_test = load_all_ranks(save_dir, num_users)
         X_test = ranks_to_feats(ranks, prop=prop, dim=dim, top_words=top_words, user_data_ratio=user_data_ratio,
                                 num_words=num_words, labels=labels, rare=rare, relative=relative,
@@ -252,7 +252,7 @@ def run_attack2(num_exp=5, num_users=5000, dim=100, prop=1.0, user_data_ratio=0.
 
         X_train, y_train = [], []
         for exp_id in range(num_exp):
-            save_dir = result_path + 'shadow_exp{}_{}/'.format(exp_id, num_users)
+            save_dir = shadow_ranks_dir(exp_id, num_users, pair, warm)
             ranks, labels, y = load_all_ranks(save_dir, num_users, cross_domain=cross_domain)
             feats = ranks_to_feats(ranks, prop=prop, dim=dim, top_words=top_words, relative=relative,
                                    num_words=num_words, labels=labels)
@@ -314,13 +314,14 @@ def run_attack3():
 if __name__ == '__main__':
     num_shadow_models = 4
     num_users = 300
+    pair = 'en-fr'
     cross_domain_flag = False
     attacker_knowledge_ratio = 0.1
 
     # attacker knowledge = 50%
     run_attack1(num_users=num_users,
                 attacker_knowledge=attacker_knowledge_ratio,
-                rerun=True)
+                rerun=True, pair=pair)
 
     print("....................................................................................................")
 
@@ -328,5 +329,5 @@ if __name__ == '__main__':
     acc, auc, pre, rec = run_attack2(num_exp=num_shadow_models,
                                      num_users=num_users,
                                      cross_domain=cross_domain_flag,
-                                     rerun=True)
+                                     rerun=True, pair=pair)
 
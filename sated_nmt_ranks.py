@@ -1,9 +1,6 @@
 import os
 import sys
-from collections import Counter, defaultdict
-from itertools import chain
 
-import tensorflow.keras.backend as K
 import numpy as np
 import scipy.stats as ss
 from sklearn.metrics import roc_auc_score, accuracy_score, classification_report
@@ -11,23 +8,19 @@ from sklearn.preprocessing import Normalizer, StandardScaler
 from sklearn.svm import SVC
 
 from helper import flatten_data
-from load_sated import process_texts, process_vocabs, load_texts, load_users, load_sated_data_by_user, \
-    SATED_TRAIN_USER, SATED_TRAIN_FR, SATED_TRAIN_ENG
-from sated_nmt import build_nmt_model, words_to_indices, MODEL_PATH, OUTPUT_PATH
+from load_sated import load_sated_data_by_user, load_user_index, load_user_texts, load_user_split, load_ragged, \
+    vocab_lut, encode_user_texts, sated_path, sated_langs
+from ragged import RaggedArray
+from sated_nmt import build_nmt_model, make_prob_fn, words_to_indices, nmt_model_path, shadow_users_path, \
+    shadow_id, OUTPUT_PATH
 
 
-def load_train_users_heldout_data(train_users, src_vocabs, trg_vocabs, user_data_ratio=0.5):
-    src_users = load_users(SATED_TRAIN_USER)
-    train_src_texts = load_texts(SATED_TRAIN_ENG)
-    train_trg_texts = load_texts(SATED_TRAIN_FR)
-
-    user_src_texts = defaultdict(list)
-    user_trg_texts = defaultdict(list)
-
-    for u, s, t in zip(src_users, train_src_texts, train_trg_texts):
-        if u in train_users:
-            user_src_texts[u].append(s)
-            user_trg_texts[u].append(t)
+def load_train_users_heldout_data(train_users, src_vocabs, trg_vocabs, user_data_ratio=0.5, pair='en-fr'):
+    path = sated_path(pair)
+    src, trg = sated_langs(path)
+    index = load_user_index(path)
+    user_src_texts = load_user_texts(train_users, path + 'train.' + src, index)
+    user_trg_texts = load_user_texts(train_users, path + 'train.' + trg, index)
 
     assert 0. < user_data_ratio < 1.
     # held out some fraction of data for testing
@@ -37,70 +30,25 @@ def load_train_users_heldout_data(train_users, src_vocabs, trg_vocabs, user_data
         user_src_texts[u] = user_src_texts[u][l:]
         user_trg_texts[u] = user_trg_texts[u][l:]
 
-    for u in train_users:
-        process_texts(user_src_texts[u], src_vocabs)
-        process_texts(user_trg_texts[u], trg_vocabs)
+    user_src_texts = encode_user_texts(user_src_texts, vocab_lut(load_ragged(path + 'train.' + src)[1], src_vocabs))
+    user_trg_texts = encode_user_texts(user_trg_texts, vocab_lut(load_ragged(path + 'train.' + trg)[1], trg_vocabs))
 
     return user_src_texts, user_trg_texts
 
 
-def load_shadow_user_data(train_users, num_users=100, num_words=10000, seed=12345):
-    src_users = load_users(SATED_TRAIN_USER)
-    train_src_texts = load_texts(SATED_TRAIN_ENG)
-    train_trg_texts = load_texts(SATED_TRAIN_FR)
-
-    user_counter = Counter(src_users)
-    all_users = [tup[0] for tup in user_counter.most_common()]
-    np.random.seed(seed)
-    np.random.shuffle(all_users)
-    np.random.seed(None)
+def load_shadow_user_data(train_users, num_users=100, num_words=10000, seed=12345, pair='en-fr'):
+    path = sated_path(pair)
+    index = load_user_index(path, seed)
+    all_users = list(index['users'])
 
     attacker_users = all_users[num_users * 2: num_users * 4]
     test_users = np.setdiff1d(attacker_users, train_users)
     print(len(train_users), len(test_users))
 
-    user_src_texts = defaultdict(list)
-    user_trg_texts = defaultdict(list)
-
-    test_user_src_texts = defaultdict(list)
-    test_user_trg_texts = defaultdict(list)
-
-    for u, s, t in zip(src_users, train_src_texts, train_trg_texts):
-        if u in train_users:
-            user_src_texts[u].append(s)
-            user_trg_texts[u].append(t)
-        if u in test_users:
-            test_user_src_texts[u].append(s)
-            test_user_trg_texts[u].append(t)
-
-    src_words = []
-    trg_words = []
-    for u in train_users:
-        src_words += list(chain(*user_src_texts[u]))
-        trg_words += list(chain(*user_trg_texts[u]))
-
-    src_vocabs = process_vocabs(src_words, num_words)
-    trg_vocabs = process_vocabs(trg_words, num_words)
-
-    for u in train_users:
-        process_texts(user_src_texts[u], src_vocabs)
-        process_texts(user_trg_texts[u], trg_vocabs)
-
-    for u in test_users:
-        process_texts(test_user_src_texts[u], src_vocabs)
-        process_texts(test_user_trg_texts[u], trg_vocabs)
-
-    src_words = []
-    trg_words = []
-
-    for u in train_users:
-        src_words += list(chain(*user_src_texts[u]))
-        trg_words += list(chain(*user_trg_texts[u]))
-
-    src_vocabs = process_vocabs(src_words, None)
-    trg_vocabs = process_vocabs(trg_words, None)
-
-    return user_src_texts, user_trg_texts, test_user_src_texts, test_user_trg_texts, src_vocabs, trg_vocabs
+    parts, vocabs = load_user_split('shadow', [num_users, num_words, seed], index, train_users, test_users,
+                                    num_words, path=path)
+    return parts['train.src'], parts['train.trg'], parts['test_user.src'], parts['test_user.trg'], \
+           vocabs['src'], vocabs['trg']
 
 
 def rank_lists(lists):
@@ -117,12 +65,12 @@ def get_ranks(user_src_data, user_trg_data, pred_fn, save_probs=False):
     labels = []
     probs = []
     for idx in indices:
-        src_text = np.asarray(user_src_data[idx], dtype=np.float32).reshape(1, -1)
-        trg_text = np.asarray(user_trg_data[idx], dtype=np.float32)
+        src_text = np.asarray(user_src_data[idx], dtype=np.int32).reshape(1, -1)
+        trg_text = np.asarray(user_trg_data[idx], dtype=np.int32)
         trg_input = trg_text[:-1].reshape(1, -1)
         trg_label = trg_text[1:].reshape(1, -1)
 
-        prob = pred_fn([src_text, trg_input, trg_label, 0])[0][0]
+        prob = pred_fn(src_text, trg_input).numpy()[0]
         if save_probs:
             probs.append(prob)
 
@@ -165,43 +113,46 @@ def save_users_rank_results(users, user_src_texts, user_trg_texts, src_vocabs, t
             sys.stderr.write('Finishing saving ranks for {} users'.format(i + 1))
 
 
+def target_ranks_dir(num_users, user_data_ratio=0., pair='en-fr'):
+    return OUTPUT_PATH + 'target_{}_{}{}/'.format(pair, num_users, '_dr' if 0. < user_data_ratio < 1. else '')
+
+
+def shadow_ranks_dir(exp_id, num_users, pair='en-fr', warm=False):
+    return OUTPUT_PATH + 'shadow_exp{}_{}_{}/'.format(shadow_id(exp_id, warm), pair, num_users)
+
+
 def histogram_feats(ranks, bins=100, num_words=5000):
     feats, _ = np.histogram(ranks, bins=bins, normed=False, range=(0, num_words))
     return feats
 
 
 def get_shadow_ranks(exp_id=0, num_users=200, num_words=5000, mask=False, h=128, emb_h=128, save_probs=False,
-                     tied=False, cross_domain=False, rnn_fn='lstm', rerun=False):
-    shadow_user_path = 'shadow_users{}_{}_{}_{}.npz'.format(exp_id, rnn_fn, num_users, 'cd' if cross_domain else '')
-    shadow_train_users = np.load(MODEL_PATH + shadow_user_path)['arr_0']
+                     tied=False, cross_domain=False, rnn_fn='lstm', rerun=False, pair='en-fr', warm=False):
+    # warm: the shadow model warm started from a base model, next to the one trained from scratch
+    shadow_user_path = shadow_users_path(exp_id, rnn_fn, num_users, cross_domain, pair, warm)
+    shadow_train_users = np.load(shadow_user_path)['arr_0']
     shadow_train_users = list(shadow_train_users)
 
     print(shadow_user_path)
 
-    save_dir = OUTPUT_PATH + 'shadow_exp{}_{}/'.format(exp_id, num_users)
-    if not os.path.exists(save_dir):
-        os.mkdir(save_dir)
+    save_dir = shadow_ranks_dir(exp_id, num_users, pair, warm)
+    os.makedirs(save_dir, exist_ok=True)
 
     # if cross_domain:
     #     user_src_texts, user_trg_texts, test_user_src_texts, test_user_trg_texts, src_vocabs, trg_vocabs \
     #         = load_cross_domain_shadow_user_data(shadow_train_users, num_users, num_words)
     # else:
     user_src_texts, user_trg_texts, test_user_src_texts, test_user_trg_texts, src_vocabs, trg_vocabs \
-        = load_shadow_user_data(shadow_train_users, num_users, num_words)
+        = load_shadow_user_data(shadow_train_users, num_users, num_words, pair=pair)
     shadow_test_users = sorted(test_user_src_texts.keys())
 
-    model_path = '{}_shadow_exp{}_{}_{}.h5'.format('europal_nmt' if cross_domain else 'sated_nmt',
-                                                   exp_id, rnn_fn, num_users)
+    model_path = nmt_model_path('{}_shadow_exp{}_{}'.format('europal_nmt' if cross_domain else 'sated_nmt',
+                                                            shadow_id(exp_id, warm), rnn_fn), num_users, pair)
 
     model = build_nmt_model(Vs=num_words, Vt=num_words, mask=mask, drop_p=0., h=h, demb=emb_h, tied=tied, rnn_fn=rnn_fn)
-    model.load_weights(MODEL_PATH + model_path)
-
-    src_input_var, trg_input_var = model.inputs
-    prediction = model.output
-    trg_label_var = K.placeholder((None, None), dtype='float32')
+    model.load_weights(model_path)
 
-    prediction = K.softmax(prediction)
-    prob_fn = K.function([src_input_var, trg_input_var, trg_label_var, K.learning_phase()], [prediction])
+    prob_fn = make_prob_fn(model)
 
     save_users_rank_results(users=shadow_train_users, save_probs=save_probs, rerun=rerun, mask=mask,
                             user_src_texts=user_src_texts, user_trg_texts=user_trg_texts,
@@ -214,35 +165,31 @@ def get_shadow_ranks(exp_id=0, num_users=200, num_words=5000, mask=False, h=128,
 
 
 def get_target_ranks(num_users=200, num_words=5000, mask=False, h=128, emb_h=128, user_data_ratio=0.,
-                     tied=False, save_probs=False):
+                     tied=False, save_probs=False, pair='en-fr'):
     user_src_texts, user_trg_texts, test_user_src_texts, test_user_trg_texts, src_vocabs, trg_vocabs \
-        = load_sated_data_by_user(num_users, num_words, test_on_user=True, user_data_ratio=user_data_ratio)
+        = load_sated_data_by_user(num_users, num_words, test_on_user=True, user_data_ratio=user_data_ratio,
+                                  pair=pair)
 
     train_users = sorted(user_src_texts.keys())
     test_users = sorted(test_user_src_texts.keys())
 
-    save_dir = OUTPUT_PATH + 'target_{}{}/'.format(num_users, '_dr' if 0. < user_data_ratio < 1. else '')
-    if not os.path.exists(save_dir):
-        os.mkdir(save_dir)
+    save_dir = target_ranks_dir(num_users, user_data_ratio, pair)
+    os.makedirs(save_dir, exist_ok=True)
 
     model_path = 'sated_nmt'.format(num_users)
 
     if 0. < user_data_ratio < 1.:
         model_path += '_dr{}'.format(user_data_ratio)
-        heldout_src_texts, heldout_trg_texts = load_train_users_heldout_data(train_users, src_vocabs, trg_vocabs)
+        heldout_src_texts, heldout_trg_texts = load_train_users_heldout_data(train_users, src_vocabs, trg_vocabs,
+                                                                             pair=pair)
         for u in train_users:
-            user_src_texts[u] += heldout_src_texts[u]
-            user_trg_texts[u] += heldout_trg_texts[u]
+            user_src_texts[u] = RaggedArray.concatenate([user_src_texts[u], heldout_src_texts[u]])
+            user_trg_texts[u] = RaggedArray.concatenate([user_trg_texts[u], heldout_trg_texts[u]])
 
     model = build_nmt_model(Vs=num_words, Vt=num_words, mask=mask, drop_p=0., h=h, demb=emb_h, tied=tied)
-    model.load_weights(MODEL_PATH + '{}_{}.h5'.format(model_path, num_users))
+    model.load_weights(nmt_model_path(model_path, num_users, pair))
 
-    src_input_var, trg_input_var = model.inputs
-    prediction = model.output
-    trg_label_var = K.placeholder((None, None), dtype='float32')
-
-    prediction = K.softmax(prediction)
-    prob_fn = K.function([src_input_var, trg_input_var, trg_label_var, K.learning_phase()], [prediction])
+    prob_fn = make_prob_fn(model)
 
     save_users_rank_results(users=train_users, save_probs=save_probs,
                             user_src_texts=user_src_texts, user_trg_texts=user_trg_texts,
@@ -314,16 +261,11 @@ def user_mi_attack(num_exp=10, dim=100, prop=1.0, num_words=5000, cross_domain=T
 def test_vocab():
     user_src_texts, user_trg_texts, test_user_src_texts, test_user_trg_texts, src_vocabs, trg_vocabs \
         = load_sated_data_by_user(300, 5000, test_on_user=True, user_data_ratio=0.)
-    train_data = []
-    test_data = []
-
-    for user in user_trg_texts:
-        train_data += user_trg_texts[user]
+    train_data = RaggedArray.concatenate(user_trg_texts.values())
     train_data = words_to_indices(train_data, trg_vocabs)
     train_data = flatten_data(train_data)
 
-    for user in test_user_trg_texts:
-        test_data += test_user_trg_texts[user]
+    test_data = RaggedArray.concatenate(test_user_trg_texts.values())
     test_data = words_to_indices(test_data, trg_vocabs)
     test_data = flatten_data(test_data)
 
@@ -338,13 +280,14 @@ def test_vocab():
 
 if __name__ == '__main__':
     num_users = 300
+    pair = 'en-fr'
     dims = list(range(64, 353, 32))
     save_probs = False
     cross_domain = False
     rerun = True
     print("Getting target ranks...")
-    get_target_ranks(num_users=num_users, save_probs=save_probs)
+    get_target_ranks(num_users=num_users, save_probs=save_probs, pair=pair)
     for i in range(10):
         print(f"Getting shadow model {i} ranks...")
         get_shadow_ranks(exp_id=i, num_users=num_users, cross_domain=cross_domain,
-                         rerun=rerun, rnn_fn='gru', h=dims[i], emb_h=dims[i])
+                         rerun=rerun, rnn_fn='gru', h=dims[i], emb_h=dims[i], pair=pair)
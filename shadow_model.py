@@ -27,6 +27,22 @@ class ShadowDecoder(tf.keras.Model):
         x = self.fc(output)
         return x, state, attention_weights
 
+    def teacher_forcing(self, x, hidden, enc_output):
+        # logits for every step of the teacher-forced inputs x in one symbolic loop instead of one call per
+        # step. The first step goes through call() so the layers are built outside the loop; after that the
+        # embeddings and the encoder side of the attention are computed once and the output layer runs once.
+        first, hidden, _ = self.call(x[:, :1], hidden, enc_output)
+        keys = self.attention.W2(enc_output)
+        zeros = tf.zeros_like(hidden)
+
+        def step(hidden, x_t):
+            context_vector, _ = self.attention(hidden, enc_output, keys)
+            state, _ = self.gru.cell(tf.concat([context_vector, x_t], axis=-1), [zeros])
+            return state
+
+        states = tf.scan(step, tf.transpose(self.embedding(x[:, 1:]), [1, 0, 2]), initializer=hidden)
+        return tf.concat([tf.expand_dims(first, 1), self.fc(tf.transpose(states, [1, 0, 2]))], axis=1)
+
 
 class ShadowEncoder(tf.keras.Model):
     def __init__(self, vocab_size, batch_sz):
@@ -55,12 +71,80 @@ class ShadowBahdanauAttention(tf.keras.layers.Layer):
         self.W2 = tf.keras.layers.Dense(units)
         self.V = tf.keras.layers.Dense(1)
 
-    def call(self, query, values):
+    def call(self, query, values, keys=None):
+        # keys: W2(values), when computed once for several queries
+        if keys is None:
+            keys = self.W2(values)
         query_with_time_axis = tf.expand_dims(query, 1)
         score = self.V(tf.nn.tanh(
-            self.W1(query_with_time_axis) + self.W2(values)))
+            self.W1(query_with_time_axis) + keys))
         attention_weights = tf.nn.softmax(score, axis=1)
         context_vector = attention_weights * values
         context_vector = tf.reduce_sum(context_vector, axis=1)
 
         return context_vector, attention_weights
+
+
+def shadow_weights(encoder, decoder):
+    # the variables of a built ShadowEncoder/ShadowDecoder pair, in the order StackedShadow keeps them
+    return [encoder.embedding.embeddings, encoder.gru.cell.kernel, encoder.gru.cell.recurrent_kernel,
+            encoder.gru.cell.bias, decoder.embedding.embeddings, decoder.gru.cell.kernel,
+            decoder.gru.cell.recurrent_kernel, decoder.gru.cell.bias, decoder.attention.W1.kernel,
+            decoder.attention.W1.bias, decoder.attention.W2.kernel, decoder.attention.W2.bias,
+            decoder.attention.V.kernel, decoder.attention.V.bias, decoder.fc.kernel, decoder.fc.bias]
+
+
+def stacked_gru_step(x, hidden, recurrent_kernel, recurrent_bias):
+    # one step of K stacked keras GRU cells (reset_after, gates z, r, h), x already multiplied by the kernel
+    # and with the input bias added; hidden (K, batch, units), recurrent_bias (K, 1, 3 * units)
+    x_z, x_r, x_h = tf.split(x, 3, axis=-1)
+    h_z, h_r, h_h = tf.split(tf.matmul(hidden, recurrent_kernel) + recurrent_bias, 3, axis=-1)
+    z = tf.sigmoid(x_z + h_z)
+    r = tf.sigmoid(x_r + h_r)
+    return z * hidden + (1 - z) * tf.tanh(x_h + r * h_h)
+
+
+class StackedShadow:
+    # K same-size ShadowEncoder/ShadowDecoder pairs as one model: each weight of shadow_weights() is stacked
+    # along a leading model axis, and every step runs as one batched matmul over it. Inputs and logits are
+    # stacked the same way, (K, batch, time, ...).
+    def __init__(self, pairs):
+        self.weights = [tf.Variable(tf.stack(weights))
+                        for weights in zip(*(shadow_weights(encoder, decoder) for encoder, decoder in pairs))]
+
+    def __call__(self, inp, dec_input):
+        # logits of the teacher-forced dec_input, as ShadowDecoder.teacher_forcing after ShadowEncoder with a
+        # zero initial state. The weights are read and split once, outside the loops over time.
+        (enc_embeddings, enc_kernel, enc_recurrent_kernel, enc_bias, dec_embeddings, dec_kernel,
+         dec_recurrent_kernel, dec_bias, w1_kernel, w1_bias, w2_kernel, w2_bias, v_kernel, v_bias,
+         fc_kernel, fc_bias) = [tf.convert_to_tensor(weight) for weight in self.weights]
+
+        enc_input_bias, enc_recurrent_bias = tf.split(enc_bias, 2, axis=1)
+        x = tf.einsum('kbtd,kdg->tkbg', tf.gather(enc_embeddings, inp, batch_dims=1), enc_kernel) + enc_input_bias
+        hidden = tf.zeros([inp.shape[0], inp.shape[1], SHADOW_UNITS])
+        enc_states = tf.scan(lambda h, x_t: stacked_gru_step(x_t, h, enc_recurrent_kernel, enc_recurrent_bias), x,
+                             initializer=hidden)
+        enc_output = tf.transpose(enc_states, [1, 2, 0, 3])
+
+        # the decoder cell input is [context, embedding]; the embedding part is multiplied for all steps at once.
+        # Its GRU always starts from a zero state, the previous state only enters through the attention query
+        context_kernel, embedding_kernel = tf.split(dec_kernel, [SHADOW_UNITS, -1], axis=1)
+        dec_input_bias, dec_recurrent_bias = tf.split(dec_bias, 2, axis=1)
+        keys = tf.einsum('kbtu,kua->kbta', enc_output, w2_kernel) + w2_bias[:, None, None]
+        x = tf.einsum('kbtd,kdg->tkbg', tf.gather(dec_embeddings, dec_input, batch_dims=1),
+                      embedding_kernel) + dec_input_bias
+        w1_bias, v_kernel, v_bias = w1_bias[:, None], v_kernel[:, None], v_bias[:, None, None]
+
+        def step(hidden, x_t):
+            query = tf.matmul(hidden, w1_kernel) + w1_bias
+            score = tf.matmul(tf.nn.tanh(query[:, :, None] + keys), v_kernel) + v_bias
+            context_vector = tf.reduce_sum(tf.nn.softmax(score, axis=2) * enc_output, axis=2)
+            x_t += tf.matmul(context_vector, context_kernel)
+            # a GRU step from a zero state: the recurrent kernel multiplies zeros and only its bias is left
+            x_z, x_r, x_h = tf.split(x_t, 3, axis=-1)
+            h_z, h_r, h_h = tf.split(dec_recurrent_bias, 3, axis=-1)
+            z = tf.sigmoid(x_z + h_z)
+            return (1 - z) * tf.tanh(x_h + tf.sigmoid(x_r + h_r) * h_h)
+
+        states = tf.transpose(tf.scan(step, x, initializer=enc_states[-1]), [1, 2, 0, 3])
+        return tf.einsum('kbtu,kuv->kbtv', states, fc_kernel) + fc_bias[:, None, None]
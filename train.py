@@ -1,27 +1,8 @@
-import re
-import unicodedata
-
 import numpy as np
 import tensorflow as tf
 
-
-def unicode_to_ascii(s):
-    return ''.join(c for c in unicodedata.normalize('NFD', s)
-                   if unicodedata.category(c) != 'Mn')
-
-
-def preprocess_sentence(w):
-    w = unicode_to_ascii(w.lower().strip())
-
-    w = re.sub(r"([?.!,¿])", r" \1 ", w)
-    w = re.sub(r'[" "]+', " ", w)
-
-    w = re.sub(r"[^a-zA-Z?.!,¿]+", " ", w)
-
-    w = w.strip()
-
-    w = '<start> ' + w + ' <end>'
-    return w
+from preprocess import preprocess_sentence
+from shadow_model import SHADOW_UNITS, StackedShadow, shadow_weights
 
 class Translate:
     def __init__(self, encoder, decoder, units, inp_lang, targ_lang, max_length_targ, max_length_inp) -> None:
@@ -36,13 +17,8 @@ class Translate:
 
     def translate(self, sentence, tensor=False):
         if tensor:
-            sen = ''
-            for word in sentence:
-                if word == 0:
-                    break
-                sen += self.inp_lang.index_word[word] + ' '
-            sentence = sen.split(' ', 1)[1]
-            sentence = sentence.rsplit(' ', 1)[0].rsplit(' ', 1)[0]
+            # drop <start> and <end>, evaluate adds them back
+            sentence = ' '.join(self.inp_lang.decode(sentence).split(' ')[1:-1])
         result, sentence, attention_plot, pred_probs = self.evaluate(
             sentence, tensor)
         return result, pred_probs
@@ -51,7 +27,7 @@ class Translate:
     def evaluate(self, sentence, tensor=False):
         attention_plot = np.zeros((self.max_length_targ, self.max_length_inp))
         sentence = preprocess_sentence(sentence)
-        inputs = [self.inp_lang.word_index[i] for i in sentence.split(' ')]
+        inputs = self.inp_lang.encode(sentence)
         inputs = tf.keras.preprocessing.sequence.pad_sequences([inputs],
                                                             maxlen=self.max_length_inp,
                                                             padding='post')
@@ -91,6 +67,15 @@ class Translate:
         return result, sentence, attention_plot, pred_probs
 
 
+def restore_checkpoint(checkpoint, manager):
+    # restores the latest checkpoint of the manager if there is one (models, optimizer state and the
+    # checkpoint.epoch variable counting finished epochs) and returns the epoch to resume from
+    if manager.latest_checkpoint:
+        checkpoint.restore(manager.latest_checkpoint)
+        print('Restored {} after epoch {}'.format(manager.latest_checkpoint, int(checkpoint.epoch.numpy())))
+    return int(checkpoint.epoch.numpy())
+
+
 class Train:
     def __init__(self, encoder, decoder, optimizer, loss_function, batch_size, targ_lang):
         super().__init__()
@@ -103,21 +88,18 @@ class Train:
 
     @tf.function
     def train_step(self, inp, targ, enc_hidden):
-        loss = 0
+        return self.step(inp, targ, enc_hidden)
 
+    def step(self, inp, targ, enc_hidden):
         with tf.GradientTape() as tape:
             enc_output, enc_hidden = self.encoder(inp, enc_hidden)
 
-            dec_hidden = enc_hidden
+            dec_input = tf.concat([tf.fill([self.batch_size, 1], self.targ_lang.word_index['<start>']),
+                                   tf.cast(targ[:, 1:-1], tf.int32)], axis=1)
+            predictions = self.decoder.teacher_forcing(dec_input, enc_hidden, enc_output)
 
-            dec_input = tf.expand_dims(
-                [self.targ_lang.word_index['<start>']] * self.batch_size, 1)
-            for t in range(1, targ.shape[1]):
-                predictions, dec_hidden, _ = self.decoder(
-                    dec_input, dec_hidden, enc_output)
-
-                loss += self.loss_function(targ[:, t], predictions)
-                dec_input = tf.expand_dims(targ[:, t], 1)
+            # loss_function averages over all steps; scaled back to the sum of the per-step averages
+            loss = self.loss_function(targ[:, 1:], predictions) * (int(targ.shape[1]) - 1)
 
         batch_loss = (loss / int(targ.shape[1]))
 
@@ -128,3 +110,79 @@ class Train:
         self.optimizer.apply_gradients(zip(gradients, variables))
 
         return batch_loss
+
+
+class StackedTrain:
+    # trains the shadow models of several Trains (same sizes, Adam optimizers) as one StackedShadow, each model on
+    # its own batch and with its own Adam state. load() copies the models' weights, Adam slots and step counts in
+    # and save() copies them back, so the checkpoint of each model is the same as if it was trained alone.
+    def __init__(self, trains):
+        self.trains = trains
+        for train in trains:
+            # builds the layers, and with them any restored checkpoint values, before they are stacked
+            enc_output, enc_hidden = train.encoder(tf.zeros([1, 1], tf.int32), tf.zeros([1, SHADOW_UNITS]))
+            train.decoder(tf.zeros([1, 1], tf.int32), enc_hidden, enc_output)
+        self.variables = [shadow_weights(train.encoder, train.decoder) for train in trains]
+        self.model = StackedShadow([(train.encoder, train.decoder) for train in trains])
+
+        optimizer = trains[0].optimizer
+        self.learning_rate, self.beta_1, self.beta_2 = (float(tf.keras.backend.get_value(getattr(optimizer, name)))
+                                                        for name in ('learning_rate', 'beta_1', 'beta_2'))
+        self.epsilon = optimizer.epsilon
+        self.m = [tf.Variable(tf.zeros_like(weight)) for weight in self.model.weights]
+        self.v = [tf.Variable(tf.zeros_like(weight)) for weight in self.model.weights]
+        self.iterations = tf.Variable(tf.zeros([len(trains)], tf.int64))
+        self.load()
+
+    def load(self):
+        for i, weight in enumerate(self.model.weights):
+            variables = [train_variables[i] for train_variables in self.variables]
+            weight.assign(tf.stack(variables))
+            for slots, name in ((self.m, 'm'), (self.v, 'v')):
+                slots[i].assign(tf.stack([train.optimizer.add_slot(var, name)
+                                          for train, var in zip(self.trains, variables)]))
+        self.iterations.assign(tf.stack([train.optimizer.iterations for train in self.trains]))
+
+    def save(self):
+        for k, (train, variables) in enumerate(zip(self.trains, self.variables)):
+            for var, weight, m, v in zip(variables, self.model.weights, self.m, self.v):
+                var.assign(weight[k])
+                train.optimizer.get_slot(var, 'm').assign(m[k])
+                train.optimizer.get_slot(var, 'v').assign(v[k])
+            train.optimizer.iterations.assign(self.iterations[k])
+
+    @tf.function
+    def train_step(self, inp, targ):
+        # inp, targ: (K, batch, time) with the batch of the k-th model at [k]; returns the K batch losses
+        train = self.trains[0]
+        with tf.GradientTape() as tape:
+            dec_input = tf.concat([tf.fill([len(self.trains), train.batch_size, 1],
+                                           train.targ_lang.word_index['<start>']),
+                                   tf.cast(targ[:, :, 1:-1], tf.int32)], axis=2)
+            predictions = self.model(inp, dec_input)
+
+            # the losses of Train.step, one per model; the models share no weights, so the gradient of their
+            # sum is the gradient of each model's own loss
+            loss = tf.stack([train.loss_function(real, pred) for train, real, pred
+                             in zip(self.trains, tf.unstack(targ[:, :, 1:]), tf.unstack(predictions))])
+            loss *= int(targ.shape[2]) - 1
+            total_loss = tf.reduce_sum(loss)
+
+        gradients = tape.gradient(total_loss, self.model.weights)
+        self.apply_gradients(gradients)
+
+        return loss / int(targ.shape[2])
+
+    def apply_gradients(self, gradients):
+        # the update of keras Adam, with the step count and so the bias correction of each model
+        self.iterations.assign_add(tf.ones_like(self.iterations))
+        t = tf.cast(self.iterations, tf.float32)
+        lr_t = self.learning_rate * tf.sqrt(1 - self.beta_2 ** t) / (1 - self.beta_1 ** t)
+        for weight, grad, m, v in zip(self.model.weights, gradients, self.m, self.v):
+            if grad is None:
+                # as in keras, e.g. the decoder's recurrent kernel, which only ever multiplies a zero state
+                continue
+            grad = tf.convert_to_tensor(grad)
+            m.assign_add((grad - m) * (1 - self.beta_1))
+            v.assign_add((tf.square(grad) - v) * (1 - self.beta_2))
+            weight.assign_sub(tf.reshape(lr_t, [-1] + [1] * (len(weight.shape) - 1)) * m / (tf.sqrt(v) + self.epsilon))
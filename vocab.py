@@ -0,0 +1,39 @@
+import numpy as np
+
+from bundle import save_bundle, load_bundle, encode_strings, decode_strings
+
+
+class Vocab:
+    # word <-> id table of a fitted Keras Tokenizer (ids start at 1, 0 is padding), saved as a flat string
+    # table so loading it needs neither pickle nor Keras.
+    def __init__(self, words):
+        self.words = np.asarray(list(words), dtype=object)
+        self.index_word = dict(enumerate(self.words.tolist(), 1))
+        self.word_index = {w: i for i, w in self.index_word.items()}
+
+    @classmethod
+    def from_tokenizer(cls, tokenizer):
+        return cls(tokenizer.index_word[i] for i in range(1, len(tokenizer.index_word) + 1))
+
+    @classmethod
+    def load(cls, path):
+        arrays, _ = load_bundle(path)
+        return cls(decode_strings(arrays['words'], arrays['offsets']))
+
+    def save(self, path):
+        words, offsets = encode_strings(self.words.tolist())
+        save_bundle(path, {'words': words, 'offsets': offsets})
+
+    def __len__(self):
+        return len(self.words)
+
+    def encode(self, sentence):
+        return [self.word_index[w] for w in sentence.split(' ')]
+
+    def decode(self, ids):
+        # words up to the first padding id
+        ids = np.asarray(ids, dtype=np.int64)
+        pad = np.flatnonzero(ids == 0)
+        if len(pad):
+            ids = ids[:pad[0]]
+        return ' '.join(self.words[ids - 1])